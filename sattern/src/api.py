@@ -1,13 +1,31 @@
-import requests
 import os
+import re
 import json
+import atexit
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
-from typing import Union, Optional, Dict, List
-from dotenv import load_dotenv
+from typing import Callable, Union, Optional, Dict, List
+from sattern.src import store, profiler
+from sattern.src.cache import cache_manager, evict_stale_files, MISSING
 
-load_dotenv()
+# Created on first use, so requests and .env are not loaded by an import of this module
+_fetcher = None
+_cache: cache_manager = None
+_env_loaded: bool = False
+
+# Daily bars only change once a day, a fresher price store is used as is
+PRICE_MAX_AGE = timedelta(days=1)
+# How long news, insider transactions and commodity prices are cached for
+CACHE_TTL = timedelta(days=6)
+# Minutes per bar of each intraday interval. A month that has not ended yet is refetched once its bars are older
+# than INTRADAY_MAX_AGE
+INTERVAL_MINUTES: Dict[str, int] = {"1min": 1, "5min": 5, "15min": 15, "30min": 30, "60min": 60}
+INTRADAY_MAX_AGE = timedelta(hours=1)
+# Names of cached files (see data_path), to register the ones from before the manifest. Commodity prices used to
+# share the "prices" name, so those are only ever read as stock prices, to migrate them into the price store
+CACHED_FILE = re.compile(r"(.+?)_(commodity_prices|prices|news|insider_transactions)_(\d{8})\.json")
 
 # TO DO: Finish up financial metrics
 def get_financial_metrics(ticker: str, start_date: Union[str, datetime], end_date: Union[str, datetime]) -> pd.DataFrame:
@@ -19,51 +37,130 @@ def get_financial_metrics(ticker: str, start_date: Union[str, datetime], end_dat
     start_date = start_date.replace(tzinfo=timezone.utc)
     end_date = end_date.replace(tzinfo=timezone.utc)
 
-    # Collect metrics
-    prices_df = get_prices(ticker)
-    insider_transactions = get_insider_transactions(ticker)
+    # Prices with insider flows and news sentiment as of each trading day, one row per day (see features).
+    # Imported here since features builds on this module
+    from sattern.src import features
+    return features.get_features(ticker, start_date, end_date)
+
+def get_prices(ticker: str) -> pd.DataFrame:
+    # Note: Start and end dates not required. Keeps the past 20 years in the price store, select needed data.
+    key = cache_key(ticker, "prices")
+    df = get_cache().recall(key)
+    if df is MISSING:
+        profiler.count("cache.prices.miss")
+        df = load_prices(ticker)
+        if df is not None:
+            get_cache().remember(key, df, PRICE_MAX_AGE)
+    return df
 
-    # Combine metrics -- TO DO for more metrics
-    if insider_transactions is not None:
-        financial_metrics = pd.concat([prices_df, insider_transactions], axis=1)
+def load_prices(ticker: str) -> pd.DataFrame:
+    if store.is_fresh(ticker, PRICE_MAX_AGE):
+        with profiler.span("cache.prices"):
+            return store.read_frame(ticker)
+
+    last_date = store.last_date(ticker)
+    if last_date is None:
+        # Nothing stored yet. Migrate a JSON cache from before the price store if there is one
+        entry = get_cache().fresh_entry(cache_key(ticker, "prices"))
+        if entry is not None:
+            file_path, _ = entry
+            # Keeps the time the JSON was fetched, so a stale one is caught up on the next call
+            store.write(ticker, read_price_json(file_path), fetched_date(file_path))
+            return store.read_frame(ticker)
+        store.write(ticker, fetch_prices(ticker, "full"))
     else:
-        financial_metrics = prices_df
-    financial_metrics = financial_metrics[(financial_metrics.index >= start_date) & (financial_metrics.index <= end_date)]
+        # Only the latest ~100 bars are needed to catch up. Fall back to the full history if that leaves a gap
+        df = fetch_prices(ticker, "compact")
+        if df.index.min() > last_date:
+            store.write(ticker, fetch_prices(ticker, "full"))
+        else:
+            store.append(ticker, df)
 
-    return financial_metrics
+    return store.read_frame(ticker)
 
-def get_prices(ticker: str) -> pd.DataFrame:
-    # Note: Start and end dates not required. Gets past 20 years, select needed data.
+def fetch_prices(ticker: str, outputsize: str) -> pd.DataFrame:
     args = {
         "function": "TIME_SERIES_DAILY",
         "symbol": ticker,
-        "outputsize": "full",
+        "outputsize": outputsize,
     }
-    file_path = path_exists(ticker, "prices")
-    if file_path is None:
-        print("Fetching prices from API")
-        url = construct_url(**args)
-        history = requests.get(url).json()
-        data = []
-        for day in history["Time Series (Daily)"]:
-            data.append(
-                {
-                "date": datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc),
-                "prices": float(history["Time Series (Daily)"][day]["4. close"]),
-                "volume": float(history["Time Series (Daily)"][day]["5. volume"]),
-                }
-            )
-        df = pd.DataFrame(data)
-        df.set_index("date", inplace=True)
-        with open(f'{Path("./sattern/src/data")}/{ticker}_prices_{datetime.now().strftime("%Y%m%d")}.json', 'w') as f:
-            df.to_json(path_or_buf=f, orient='columns', date_format='iso')
-    else:
-        with open(file_path, 'r') as f:
-            df = pd.read_json(path_or_buf=f, orient='columns')
-        df.index = pd.to_datetime(df.index, format='%Y-%m-%d').tz_convert(tz=timezone.utc)
-
+    print(f"Fetching prices from API ({outputsize})")
+    url = construct_url(**args)
+    with profiler.span("fetch.prices"):
+        history = get_fetcher().get_json(url)
+    data = []
+    for day in history["Time Series (Daily)"]:
+        data.append(
+            {
+            "date": datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc),
+            "prices": float(history["Time Series (Daily)"][day]["4. close"]),
+            "volume": float(history["Time Series (Daily)"][day]["5. volume"]),
+            }
+        )
+    df = pd.DataFrame(data)
+    df.set_index("date", inplace=True)
     return df
 
+def get_intraday_prices(ticker: str, interval: str = "5min", start_date: datetime = None, end_date: datetime = None) -> pd.DataFrame:
+    # Intraday bars between start_date and end_date (default the last 30 days), laid out like get_prices.
+    # History is fetched and stored one month at a time, so only months that are missing (or still running and
+    # stale) are requested, concurrently through the shared fetcher. Not kept in the in-process LRU, a few months
+    # of 1min bars are hundreds of thousands of rows
+    if interval not in INTERVAL_MINUTES:
+        raise ValueError(f"Unknown interval {interval}, expected one of {', '.join(INTERVAL_MINUTES)}")
+    end_date = pd.Timestamp(end_date or datetime.now(timezone.utc))
+    end_date = end_date.tz_localize("UTC") if end_date.tzinfo is None else end_date
+    start_date = pd.Timestamp(start_date) if start_date is not None else end_date - timedelta(days=30)
+    start_date = start_date.tz_localize("UTC") if start_date.tzinfo is None else start_date
+
+    now = datetime.now(timezone.utc)
+    stale = []
+    for month in pd.period_range(start_date.tz_localize(None), end_date.tz_localize(None), freq="M"):
+        if month.start_time.replace(tzinfo=timezone.utc) > now:
+            continue
+        updated = store.month_updated(ticker, interval, str(month))
+        # A month fetched after it ended never changes again
+        month_end = (month + 1).start_time.replace(tzinfo=timezone.utc)
+        if updated is None or (updated < month_end and now - updated >= INTRADAY_MAX_AGE):
+            stale.append(str(month))
+        else:
+            profiler.count("cache.intraday.hit")
+
+    def ingest(month: str) -> int:
+        df = fetch_intraday_prices(ticker, interval, month)
+        store.write_month(ticker, interval, month, df)
+        return len(df)
+    if stale:
+        profiler.count("cache.intraday.miss", len(stale))
+        get_fetcher().map(ingest, stale)
+
+    with profiler.span("cache.intraday"):
+        return store.read_intraday_frame(ticker, interval, start_date, end_date)
+
+def fetch_intraday_prices(ticker: str, interval: str, month: str) -> pd.DataFrame:
+    # One month ("YYYY-MM") of regular hours bars
+    args = {
+        "function": "TIME_SERIES_INTRADAY",
+        "symbol": ticker,
+        "interval": interval,
+        "month": month,
+        "outputsize": "full",
+        "extended_hours": "false",
+    }
+    print(f"Fetching {interval} prices from API ({month})")
+    url = construct_url(**args)
+    with profiler.span("fetch.intraday"):
+        history = get_fetcher().get_json(url)
+    bars = history.get(f"Time Series ({interval})", {})
+    # Timestamps are exchange local time, the zone is given in the metadata
+    time_zone = history.get("Meta Data", {}).get("6. Time Zone", "US/Eastern")
+    index = pd.to_datetime(list(bars.keys()), format='%Y-%m-%d %H:%M:%S').tz_localize(time_zone, ambiguous="NaT", nonexistent="NaT").tz_convert(timezone.utc)
+    df = pd.DataFrame({
+        "prices": np.array([float(bar["4. close"]) for bar in bars.values()]),
+        "volume": np.array([float(bar["5. volume"]) for bar in bars.values()]),
+    }, index=index.rename("date"))
+    return df[df.index.notna()]
+
 def get_news(ticker: str, start_date: datetime, end_date: datetime) -> Dict:
     args = {
         "function": "NEWS_SENTIMENT",
@@ -73,16 +170,13 @@ def get_news(ticker: str, start_date: datetime, end_date: datetime) -> Dict:
         "sort": "LATEST",
         "limit": 1000,
     }
-    file_path = path_exists(ticker, "news")
-    if file_path is None:
+    news = load_cached(ticker, "news", read_json)
+    if news is MISSING:
         print("Fetching news from API")
         url = construct_url(**args)
-        news = requests.get(url).json()
-        with open(f'{Path("./sattern/src/data")}/{ticker}_news_{datetime.now().strftime("%Y%m%d")}.json', 'w') as f:
-            json.dump(news, f)
-    else:
-        with open(file_path, 'r') as f:
-            news = json.load(f)
+        with profiler.span("fetch.news"):
+            news = get_fetcher().get_json(url)
+        get_cache().put(cache_key(ticker, "news"), news, data_path(ticker, "news"), write_json, CACHE_TTL)
     return news
 
 def get_insider_transactions(ticker: str) -> pd.DataFrame:
@@ -91,47 +185,42 @@ def get_insider_transactions(ticker: str) -> pd.DataFrame:
         "function": "INSIDER_TRANSACTIONS",
         "symbol": ticker
     }
-    file_path = path_exists(ticker, "insider_transactions")
-    if file_path is None:
+    df = load_cached(ticker, "insider_transactions", read_insider_transactions)
+    if df is MISSING:
         print("Fetching insider transactions from API")
         url = construct_url(**args)
-        insider_transactions = requests.get(url).json()
-        if insider_transactions["data"] == []:
-            print(f"No insider transactions found for {ticker}")
-            with open(f'{Path("./sattern/src/data")}/{ticker}_insider_transactions_{datetime.now().strftime("%Y%m%d")}.json', 'w') as f:
-                pass
-            return None
-        data = []
-        for transaction in insider_transactions["data"]:
-            data.append(
-                {
-                "date": datetime.strptime(transaction["transaction_date"], "%Y-%m-%d").replace(tzinfo=timezone.utc),
-                "acquisition_or_disposal": transaction["acquisition_or_disposal"],
-                "shares": transaction["shares"],
-                "share_price": transaction["share_price"]
-                }
-            )
-        df = pd.DataFrame(data)
-        with open(f'{Path("./sattern/src/data")}/{ticker}_insider_transactions_{datetime.now().strftime("%Y%m%d")}.json', 'w') as f:
-            df.to_json(path_or_buf=f, orient='records', date_format='iso')
-    else:
-        with open(file_path, 'r') as f:
-            if os.stat(file_path).st_size == 0:
-                print(f"No insider transactions found for {ticker}")
-                return None
-            df = pd.read_json(path_or_buf=f, orient='records')
+        with profiler.span("fetch.insider_transactions"):
+            insider_transactions = get_fetcher().get_json(url)
+        df = None
+        if insider_transactions["data"] != []:
+            data = []
+            for transaction in insider_transactions["data"]:
+                data.append(
+                    {
+                    "date": datetime.strptime(transaction["transaction_date"], "%Y-%m-%d").replace(tzinfo=timezone.utc),
+                    "acquisition_or_disposal": transaction["acquisition_or_disposal"],
+                    "shares": transaction["shares"],
+                    "share_price": transaction["share_price"]
+                    }
+                )
+            df = pd.DataFrame(data)
+        get_cache().put(cache_key(ticker, "insider_transactions"), df, data_path(ticker, "insider_transactions"), write_insider_transactions, CACHE_TTL)
+    if df is None:
+        print(f"No insider transactions found for {ticker}")
     return df
 
 def get_commodity_prices(ticker: str) -> pd.DataFrame:
+    # Cached under commodity_prices so a commodity can never be read back as an equity's prices (or vice versa)
     args = {
         "function": ticker,
         "interval": "daily",
     }
-    file_path = path_exists(ticker, "prices")
-    if file_path is None:
+    df = load_cached(ticker, "commodity_prices", read_price_json)
+    if df is MISSING:
         print("Fetching commodoties prices from API")
         url = construct_url(**args)
-        prices = requests.get(url).json()
+        with profiler.span("fetch.commodity_prices"):
+            prices = get_fetcher().get_json(url)
         data = []
         for day in prices["data"]:
             try:
@@ -145,28 +234,136 @@ def get_commodity_prices(ticker: str) -> pd.DataFrame:
                 pass
         df = pd.DataFrame(data)
         df.set_index("date", inplace=True)
-        with open(f'{Path("./sattern/src/data")}/{ticker}_prices_{datetime.now().strftime("%Y%m%d")}.json', 'w') as f:
-            df.to_json(path_or_buf=f, orient='columns', date_format='iso')
-    else:
-        with open(file_path, 'r') as f:
-            df = pd.read_json(path_or_buf=f, orient='columns')
-        df.index = pd.to_datetime(df.index, format='%Y-%m-%d').tz_convert(tz=timezone.utc)
+        get_cache().put(cache_key(ticker, "commodity_prices"), df, data_path(ticker, "commodity_prices"), write_price_json, CACHE_TTL)
+
+    return df
+
+def cache_key(ticker: str, name: str) -> str:
+    return f"{name}/{ticker}"
+
+def data_path(ticker: str, name: str) -> Path:
+    return Path("./sattern/src/data") / f'{ticker}_{name}_{datetime.now().strftime("%Y%m%d")}.json'
+
+def load_cached(ticker: str, name: str, loader: Callable[[Path], object]) -> object:
+    # Cached value of ticker/name, or MISSING if it has to be fetched
+    with profiler.span(f"cache.{name}"):
+        value = get_cache().get(cache_key(ticker, name), loader)
+    profiler.count(f"cache.{name}.{'miss' if value is MISSING else 'hit'}")
+    return value
+
+def read_json(file_path: Path) -> Dict:
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+def write_json(file_path: Path, data: Dict):
+    with open(file_path, 'w') as f:
+        json.dump(data, f)
 
+def read_insider_transactions(file_path: Path) -> pd.DataFrame:
+    # An empty file records that the ticker has no insider transactions
+    if os.stat(file_path).st_size == 0:
+        return None
+    with open(file_path, 'r') as f:
+        return pd.read_json(path_or_buf=f, orient='records')
+
+def write_insider_transactions(file_path: Path, df: pd.DataFrame):
+    with open(file_path, 'w') as f:
+        if df is not None:
+            df.to_json(path_or_buf=f, orient='records', date_format='iso')
+
+def read_price_json(file_path: Path) -> pd.DataFrame:
+    with open(file_path, 'r') as f:
+        df = pd.read_json(path_or_buf=f, orient='columns')
+    df.index = pd.to_datetime(df.index, format='%Y-%m-%d').tz_convert(tz=timezone.utc)
     return df
 
+def write_price_json(file_path: Path, df: pd.DataFrame):
+    with open(file_path, 'w') as f:
+        df.to_json(path_or_buf=f, orient='columns', date_format='iso')
+
+def get_cache() -> cache_manager:
+    global _cache
+    if _cache is None:
+        _cache = cache_manager()
+        if not _cache.manifest_path.exists():
+            register_cached_files(_cache)
+    return _cache
+
+def register_cached_files(cache: cache_manager):
+    # Register the newest file of each key cached before the manifest existed, once, when the manifest is created.
+    # After that the manifest is trusted, a miss never probes the disk for date stamped names
+    newest: Dict[str, Path] = {}
+    # Names sort by date within a key, so the newest file of each key is seen last
+    for file_path in sorted(cache.root.glob("*.json")):
+        match = CACHED_FILE.fullmatch(file_path.name)
+        if match is not None:
+            newest[cache_key(match.group(1), match.group(2))] = file_path
+    for key, file_path in newest.items():
+        cache.register(key, file_path, CACHE_TTL, fetched_date(file_path))
+        evict_stale_files(file_path)
+    # An existing manifest marks these as registered, even if there were none
+    cache.flush(force=True)
+
+def set_cache(new_cache: cache_manager):
+    global _cache
+    if _cache is not None:
+        _cache.flush()
+    _cache = new_cache
+
+@atexit.register
+def flush_cache():
+    # Manifest entries are batched (see cache_manager), write what is left when the process ends
+    if _cache is not None:
+        _cache.flush()
+
+def getenv(name: str, default: str = None) -> str:
+    # .env is read the first time a setting is needed
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _env_loaded = True
+    return os.getenv(name, default)
+
+def get_fetcher():
+    # Shared by every API call. STOCK_API_RPM sets the requests per minute the API key allows
+    global _fetcher
+    if _fetcher is None:
+        from sattern.src.fetcher import fetcher
+        _fetcher = fetcher(requests_per_minute=float(getenv('STOCK_API_RPM', 5)))
+    return _fetcher
+
+def set_fetcher(new_fetcher):
+    global _fetcher
+    _fetcher = new_fetcher
+
+def fetch_universe(tickers: List[str], start_date: datetime, end_date: datetime, endpoints: List[str] = None) -> Dict[str, Dict]:
+    # Load (fetching where the cache is stale) every endpoint for every ticker concurrently. Requests share the
+    # fetcher's connection pool and rate limit
+    if endpoints is None:
+        endpoints = ["prices", "news", "insider_transactions"]
+    loaders = {
+        "prices": lambda ticker: get_prices(ticker),
+        "news": lambda ticker: get_news(ticker, start_date, end_date),
+        "insider_transactions": lambda ticker: get_insider_transactions(ticker),
+        "commodity_prices": lambda ticker: get_commodity_prices(ticker),
+    }
+    jobs = [(ticker, endpoint) for ticker in tickers for endpoint in endpoints]
+    results = get_fetcher().map(lambda job: loaders[job[1]](job[0]), jobs)
+    # One manifest write for the whole universe
+    get_cache().flush()
+    data: Dict[str, Dict] = {ticker: {} for ticker in tickers}
+    for (ticker, endpoint), result in zip(jobs, results):
+        data[ticker][endpoint] = result
+    return data
+
 def construct_url(**args) -> str:
-    url = f'https://www.alphavantage.co/query?'
+    url = f"{getenv('STOCK_API_URL', 'https://www.alphavantage.co/query')}?"
     for arg in args.keys():
         url += f"{arg}={args[arg]}&"
-    url += f"apikey={os.getenv('STOCK_API_KEY')}"
+    url += f"apikey={getenv('STOCK_API_KEY')}"
     return url
 
-def path_exists(ticker: str, name: str) -> str:
-    file_path = f'{Path("./sattern/src/data")}/{ticker}_{name}_'
-    # {datetime.now().strftime("%Y%m%d")}.json
-    date_range = [(datetime.now(timezone.utc) - timedelta(days=i)).strftime('%Y%m%d') for i in range(6)]
-    for date in date_range:
-        if os.path.exists(file_path + date + ".json"):
-            return file_path + date + ".json"
-    print(f"File not found: {ticker} // {name}")
-    return None
+def fetched_date(file_path: str) -> datetime:
+    # Day a file cached before the manifest was fetched on, from the date in its name (see data_path)
+    return datetime.strptime(Path(file_path).stem.rsplit("_", 1)[1], "%Y%m%d").replace(tzinfo=timezone.utc)
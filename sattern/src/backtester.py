@@ -1,17 +1,29 @@
 from datetime import datetime, timedelta, timezone
 from typing import Union, Tuple, Dict, List
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from sattern.src import api, process, trader, display
-from pathlib import Path
+from sattern.src import api, process, trader, display, profiler, results, signal_cache, features
+from concurrent.futures import ProcessPoolExecutor
 import json
 
+# Bars of history each intraday decision matches against (about two months of 5min bars), in place of the 730 day
+# lookback of daily backtests. Regular trading hours are 390 minutes a day
+INTRADAY_LOOKBACK_BARS = 4000
+MINUTES_PER_DAY = 390
 
 class Backtester:
-    def __init__(self, ticker: str, start_date: datetime, end_date: datetime, init_capital: float, display: bool, periods: List[int], commodity: bool = False):
+    def __init__(self, ticker: str, start_date: datetime, end_date: datetime, init_capital: float, display: bool, periods: List[int], commodity: bool = False, prices: pd.DataFrame = None, max_diff: float = 2, interval: str = "daily", mode: str = "greedy", lookback_bars: int = INTRADAY_LOOKBACK_BARS, every: int = 1):
+        # interval "1min", "5min", ... backtests intraday bars (api.get_intraday_prices): each decision matches the
+        # last lookback_bars bars, and mode "fft" keeps that independent of the period. every trades on every
+        # <every>-th bar only, the equity curve is still valued at every bar
         self.ticker = ticker
         self.display = display
         self.periods = periods
+        self.max_diff = max_diff
+        self.interval = interval
+        self.mode = mode
+        self.lookback_bars = lookback_bars
+        self.every = every
 
         if start_date > end_date:
             start_date, end_date = end_date, start_date
@@ -23,91 +35,178 @@ class Backtester:
         self.init_capital = init_capital
         self.portfolio: trader.portfolio = trader.portfolio(init_capital)
         self.portfolio_value = 0
-        self.portfolio_values = []
+        # Equity curve of the last replay, one entry per bar
+        self.portfolio_dates = pd.DatetimeIndex([], tz="UTC")
+        self.portfolio_values = np.zeros(0)
 
         self.commodity: bool = commodity
 
-        if commodity:
-            self.prices: pd.DataFrame = api.get_commodity_prices(ticker)
+        # Prices can be handed in by a caller that already loaded them (see farm.run_farm)
+        with profiler.span("backtest.load"):
+            if prices is not None:
+                self.prices: pd.DataFrame = prices
+            elif commodity:
+                self.prices: pd.DataFrame = api.get_commodity_prices(ticker)
+            elif self.intraday:
+                # Enough calendar days before the start to fill the lookback of the first decision
+                lookback_days = int(np.ceil(lookback_bars / self.bars_per_day * 7 / 5)) + 5
+                self.prices: pd.DataFrame = api.get_intraday_prices(ticker, interval, self.start_date - timedelta(days=lookback_days), self.end_date)
+            else:
+                self.prices: pd.DataFrame = api.get_prices(ticker)
+            if not commodity:
+                self.news: Dict = api.get_news(ticker, start_date, end_date)
+                self.insider_transactions: pd.DataFrame = api.get_insider_transactions(ticker)
+        # Prices, news sentiment and insider flows as of every bar, built once per set of inputs and read back from
+        # disk after that (see features)
+        if not commodity:
+            with profiler.span("backtest.features"):
+                name = ticker if not self.intraday else f"{ticker}_{interval}"
+                self.features: pd.DataFrame = features.feature_frame(ticker, self.prices, self.news, self.insider_transactions, name=name)
+
+    @property
+    def intraday(self) -> bool:
+        return self.interval != "daily"
+
+    @property
+    def bars_per_day(self) -> float:
+        return MINUTES_PER_DAY / api.INTERVAL_MINUTES[self.interval] if self.intraday else 1
+
+    @property
+    def time_of_day(self) -> timedelta:
+        # Daily backtests step through the business days at the time of day of start_date, so a day counts up to
+        # that time (pd.date_range(start_date, end_date, freq="B") before trading_windows)
+        start = pd.Timestamp(self.start_date)
+        return timedelta(0) if self.intraday else start - start.normalize()
+
+    def bar_dates(self) -> pd.DatetimeIndex:
+        # Every bar of the backtest, oldest first
+        dates = self.prices.index[::-1]
+        start = pd.Timestamp(self.start_date)
+        first = dates.searchsorted(start if self.intraday else start.normalize(), side="left")
+        last = dates.searchsorted(pd.Timestamp(self.end_date) - self.time_of_day, side="right")
+        return dates[first:last]
+
+    def trading_windows(self, lookback: timedelta = timedelta(days=730)) -> Tuple[pd.DatetimeIndex, np.ndarray, np.ndarray]:
+        # Resolve every trading day (every <every>-th bar) in the backtest to the rows of its lookback window in
+        # self.prices (newest first). Row i is the trading day and the window runs from row i up to (not including)
+        # window_ends[i]. Intraday windows are the last lookback_bars bars instead of a time span
+        dates = self.prices.index[::-1]
+        trading_days = self.bar_dates()[::self.every]
+        positions = dates.searchsorted(trading_days, side="left")
+        rows = len(dates) - 1 - positions
+        if self.intraday:
+            window_ends = np.minimum(rows + self.lookback_bars, len(dates))
         else:
-            self.prices: pd.DataFrame = api.get_prices(ticker)
-            self.news: Dict = api.get_news(ticker, start_date, end_date)
+            # The window of a day reaches back lookback from the time the day is traded at
+            window_ends = len(dates) - dates.searchsorted(trading_days + self.time_of_day - lookback, side="left")
+        return trading_days, rows, window_ends
+
+    def signal_matrix(self, max_workers: int = 1) -> pd.DataFrame:
+        # Phase one of the backtest: the signal_score of every signal on every trading day. Signals only depend on
+        # the data, not on the portfolio, so this can be cached and replayed with different position sizing
+        dates, rows, window_ends = self.trading_windows()
+        prices = self.prices["prices"].to_numpy(dtype=float)
+
+        # Days already scored by an earlier run (see signal_cache) are read back, only the rest are matched
+        with profiler.span("backtest.signal_cache"):
+            keys = signal_cache.window_keys(dates.as_unit("ns").asi8, prices, rows, window_ends)
+            signals = {f"sattern_{period}": signal_cache.lookup(self.ticker, self.mode, period, self.max_diff, keys) for period in self.periods}
+            missing = np.flatnonzero(np.isnan(np.column_stack(list(signals.values()))).any(axis=1)) if signals else np.zeros(0, dtype=np.int64)
+        profiler.count("backtest.signal_cache.hit", len(rows) - len(missing))
 
-    def run_backtesting(self):
-        dates = pd.date_range(self.start_date, self.end_date, freq="B")
+        with profiler.span("backtest.sattern"):
+            if max_workers > 1 and len(missing) > 0:
+                chunks = [chunk for chunk in np.array_split(missing, max_workers) if len(chunk)]
+                with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                    futures = []
+                    for chunk in chunks:
+                        # Only send each worker the slice of history its days look back over
+                        first, last = rows[chunk].min(), window_ends[chunk].max()
+                        futures.append(pool.submit(sattern_scores, prices[first:last], rows[chunk] - first, window_ends[chunk] - first, self.periods, self.max_diff, self.mode))
+                    parts = [future.result() for future in futures]
+                computed = {column: np.concatenate([part[column] for part in parts]) for column in parts[0]}
+            elif len(missing) > 0:
+                computed = sattern_scores(prices, rows[missing], window_ends[missing], self.periods, self.max_diff, self.mode)
+
+        if len(missing) > 0:
+            with profiler.span("backtest.signal_cache"):
+                for period in self.periods:
+                    column = f"sattern_{period}"
+                    signals[column][missing] = computed[column]
+                    signal_cache.save(self.ticker, self.mode, period, self.max_diff, keys[missing], computed[column])
+
+        signals.update(self.context_signals(dates))
+        return pd.DataFrame(signals, index=dates)
+
+    def context_signals(self, dates: pd.DatetimeIndex) -> Dict[str, np.ndarray]:
+        # signal_score of the news and insider signals on each date, these do not depend on any sattern parameter
+        # Commodoties dont have insider trading or news data. News sentiment is taken over the 30 days before each day,
+        # insider flows are summed over every transaction before it. Tickers without any transactions are left out
+        if self.commodity:
+            return {}
+        with profiler.span("backtest.context"):
+            columns = [column for column in ("news", "insider_transactions") if column in self.features.columns]
+            return features.at(self.features, dates, columns)
+
+    def replay(self, signals: pd.DataFrame, **sizing) -> pd.DataFrame:
+        # Phase two of the backtest: combine the signals and trade them through the portfolio.
+        # sizing is passed to trader.combine_signal_scores (budget, thresholds). Starts from a fresh portfolio every time
+        self.portfolio = trader.portfolio(self.init_capital)
+        curr_prices = self.prices["prices"].loc[signals.index].to_numpy(dtype=float)
+        with profiler.span("backtest.trade"):
+            action_codes, quantities = trader.combine_signal_scores(signals.to_numpy(dtype=float), curr_prices, **sizing)
+            executed, cash, stock = trader.replay_trades(action_codes, quantities, curr_prices, self.portfolio.cash, self.portfolio.stock)
+        total_value = cash + stock * curr_prices
+
+        if len(signals) > 0:
+            self.portfolio.cash, self.portfolio.stock = float(cash[-1]), float(stock[-1])
+            # Holdings carry over between trading bars, so every bar from the first trade on is valued with the
+            # cash and stock of the last trade at or before it
+            bars = self.bar_dates()
+            bars = bars[bars.searchsorted(signals.index[0]):]
+            last_trade = signals.index.searchsorted(bars, side="right") - 1
+            self.portfolio_dates = bars
+            self.portfolio_values = cash[last_trade] + stock[last_trade] * self.prices["prices"].loc[bars].to_numpy(dtype=float)
+            self.portfolio_value = self.portfolio_values[-1]
+        else:
+            self.portfolio_dates, self.portfolio_values = signals.index, total_value
+        return pd.DataFrame({
+            "Action": np.array(trader.ACTIONS)[action_codes],
+            "Quantity": executed,
+            "Price": curr_prices,
+            "Cash": cash,
+            "Stock": stock,
+            "Total Value": total_value,
+        }, index=signals.index)
 
+    def run_backtesting(self, max_workers: int = 1):
         if self.display:
             print("\nStarting backtest...")
-            print(f"{'Date':<12} {'Ticker':<6} {'Action':<6} {'Quantity':>8} {'Price':>8} {'Cash':>12} {'Stock':>8} {'Total Value':>12}")
-            print("-" * 100)
         else:
             print(f"\nStarting Backtest on {self.ticker}...")
 
-        for curr_date in dates:
-            curr_start_date = (curr_date - timedelta(days=730))
-            test_df = self.prices.loc[curr_date:curr_start_date].copy()
-
-            actions = {}
-            for period in self.periods:
-                p_sattern, sattern_action = process.sattern(test_df["prices"], period)
-                actions[f"sattern_{period}"] = sattern_action['action']
-            if not self.commodity:
-                # Commodoties dont have insider trading or news data
-                filtered_news: Dict[str, List] = {"feed": []}
-                for article in self.news["feed"]:
-                    time_published = datetime.strptime(article["time_published"], "%Y%m%dT%H%M%S").replace(tzinfo=timezone.utc)
-                    if time_published < curr_date:
-                        filtered_news["feed"].append(article)
-                p_news = process.process_news(self.ticker, filtered_news)
-                # p_insider_transactions = process.process_insider_transactions(insider_trades)
-                actions['news'] = p_news['action']
-                # actions['insider_transactions'] = p_insider_transactions['action']
-
-            curr_price = test_df.iloc[0]['prices']
-            executed_action, executed_quantity = self.portfolio.execute_trade(action=actions, current_price=curr_price)
-
-            total_value = self.portfolio.cash + self.portfolio.stock * curr_price
-            self.portfolio_values.append(
-                {"Date": curr_date.strftime('%Y-%m-%d'), "Portfolio Value": total_value}
-            )
-            self.portfolio_value = total_value
-
-            if self.display:
+        trades = self.replay(self.signal_matrix(max_workers))
+
+        if self.display:
+            profiler.count("backtest.print", len(trades))
+            print(f"{'Date':<12} {'Ticker':<6} {'Action':<6} {'Quantity':>8} {'Price':>8} {'Cash':>12} {'Stock':>8} {'Total Value':>12}")
+            print("-" * 100)
+            for curr_date, trade in trades.iterrows():
                 print(
-                    f"{curr_date.strftime('%Y-%m-%d'):<12} {self.ticker:<6} {executed_action:<6} {executed_quantity:>8} {curr_price:>8.2f} "
-                    f"{self.portfolio.cash:>12.2f} {self.portfolio.stock:>8} {total_value:>12.2f}"
+                    f"{curr_date.strftime('%Y-%m-%d'):<12} {self.ticker:<6} {trade['Action']:<6} {trade['Quantity']:>8} {trade['Price']:>8.2f} "
+                    f"{trade['Cash']:>12.2f} {trade['Stock']:>8} {trade['Total Value']:>12.2f}"
                 )
 
     def analyze_performance(self) -> Tuple[pd.DataFrame, float]:
-        performance_df = pd.DataFrame(self.portfolio_values)
-        performance_df['Date'] = pd.to_datetime(performance_df['Date'], utc=True)
-        performance_df.set_index('Date', inplace=True)
+        performance_df = pd.DataFrame({"Portfolio Value": self.portfolio_values}, index=self.portfolio_dates.rename("Date"))
 
         # Calculate total return
         total_return = (self.portfolio_value - self.init_capital) / self.init_capital * 100
         print(f"Total Return: {total_return:.2f}%")
 
-        # Calculate stock growth
-        self.start_date = pd.to_datetime(self.start_date, utc=True).normalize()
-        self.end_date = pd.to_datetime(self.end_date, utc=True).normalize()
-
-        # Ensure dates are valid
-        attempts = 0
-        while attempts < 10:
-            try:
-                start_price = self.prices.loc[self.start_date]['prices']
-                break
-            except KeyError:
-                self.start_date = self.start_date - timedelta(days=1)
-                attempts += 1
-        attempts = 0
-        while attempts < 10:
-            try:
-                end_price = self.prices.loc[self.end_date]['prices']
-                break
-            except KeyError:
-                self.end_date = self.end_date - timedelta(days=1)
-                attempts += 1
+        # Calculate stock growth, from the last bar at or before the start and end dates (the day they fall on)
+        self.start_date, start_price = self.price_at(self.start_date)
+        self.end_date, end_price = self.price_at(self.end_date)
 
         total_growth = (
             (end_price - start_price) / start_price
@@ -117,46 +216,74 @@ class Backtester:
         # Compute daily returns
         performance_df["Daily Return"] = performance_df["Portfolio Value"].pct_change()
 
-        # Calculate Sharpe Ratio (assuming 252 trading days in a year)
-        mean_daily_return = performance_df["Daily Return"].mean()
-        std_daily_return = performance_df["Daily Return"].std()
-        if std_daily_return != 0:
-            sharpe_ratio = (mean_daily_return / std_daily_return) * (252 ** 0.5)
-        else:
-            sharpe_ratio = 0
-        print(f"Sharpe Ratio: {sharpe_ratio:.2f}")
+        metrics = performance_metrics(performance_df["Portfolio Value"], self.init_capital, 252 * self.bars_per_day)
+        print(f"Sharpe Ratio: {metrics['sharpe_ratio']:.2f}")
+        print(f"Maximum Drawdown: {metrics['max_drawdown'] * 100:.2f}%")
 
-        # Calculate Maximum Drawdown
-        rolling_max = performance_df["Portfolio Value"].cummax()
-        drawdown = performance_df["Portfolio Value"] / rolling_max - 1
-        max_drawdown = drawdown.min()
-        print(f"Maximum Drawdown: {max_drawdown * 100:.2f}%")
-
-        if self.display:
+        if self.display and not display.headless():
             price_subset = self.prices.loc[self.end_date:self.start_date]['prices']
             price_subset = (price_subset / price_subset.iloc[-1]) * self.init_capital
             graph = display.custom_plot(self.ticker, price_subset)
             graph.plot(performance_df[["Portfolio Value"]], "Portfolio Value ($)", "green")
             graph.show()
 
-        return total_growth
+        return performance_df, total_return
+
+    def price_at(self, date: datetime) -> Tuple[pd.Timestamp, float]:
+        date = pd.to_datetime(date, utc=True)
+        dates = self.prices.index[::-1]
+        i = dates.searchsorted(date if self.intraday else date.normalize(), side="right") - 1
+        return dates[i], float(self.prices["prices"].iloc[len(dates) - 1 - i])
 
-    def plot_old_performance(self, file_name:str, ticker:str):
-        file_path = f'{Path("./sattern/src/backtesting_results")}/{file_name}'
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        df = pd.DataFrame(data[ticker]).T
-        df.index = pd.to_datetime(df.index, utc=True)
+    def plot_old_performance(self, file_name:str, ticker:str, run: int = None):
+        # file_name is a result set saved with results.append_run (the latest run unless run is given). Older
+        # results saved as one JSON file are still read whole
+        if file_name.endswith(".json"):
+            with open(f'{results.RESULTS_PATH}/{file_name}', 'r') as f:
+                data = json.load(f)
+            df = pd.DataFrame(data[ticker]).T
+            df.index = pd.to_datetime(df.index, utc=True)
+        else:
+            df = results.read(file_name, ticker, self.start_date, self.end_date, run, ["Portfolio Value"])
         price_subset = self.prices.loc[self.end_date:self.start_date]['prices']
         price_subset = (price_subset / price_subset.iloc[-1]) * self.init_capital
         graph = display.custom_plot(self.ticker, price_subset)
         graph.plot(df['Portfolio Value'], "Portfolio Value ($)", "green")
         graph.show()
 
+def sattern_scores(prices: np.ndarray, rows: np.ndarray, window_ends: np.ndarray, periods: List[int], max_diff: float = 2, mode: str = "greedy") -> Dict[str, np.ndarray]:
+    # signal_score of sattern_multi (in mode, see process.sattern) for each window, one column per period
+    diffs = process.price_diffs(prices)
+    scores = {f"sattern_{period}": np.empty(len(rows)) for period in periods}
+    for i, (row, window_end) in enumerate(zip(rows, window_ends)):
+        # Views into the full history, nothing is copied per day
+        sattern_actions = process.sattern_multi(prices[row:window_end], periods, max_diff, diffs=diffs[row:window_end - 1], mode=mode)
+        for period, sattern_action in sattern_actions.items():
+            scores[f"sattern_{period}"][i] = trader.signal_score(sattern_action['action'])
+    return scores
+
+def performance_metrics(portfolio_values: Union[pd.Series, np.ndarray], init_capital: float, periods_per_year: float = 252) -> Dict[str, float]:
+    # Total return (%), Sharpe ratio and maximum drawdown of portfolio values sampled periods_per_year times a year
+    # (252 trading days for daily values)
+    values = pd.Series(np.asarray(portfolio_values, dtype=float))
+    if len(values) == 0:
+        return {"total_return": 0.0, "sharpe_ratio": 0.0, "max_drawdown": 0.0}
+    daily_return = values.pct_change()
+    mean_daily_return, std_daily_return = daily_return.mean(), daily_return.std()
+    if std_daily_return != 0:
+        sharpe_ratio = (mean_daily_return / std_daily_return) * (periods_per_year ** 0.5)
+    else:
+        sharpe_ratio = 0
+    return {
+        "total_return": (values.iloc[-1] - init_capital) / init_capital * 100,
+        "sharpe_ratio": float(sharpe_ratio),
+        "max_drawdown": float((values / values.cummax() - 1).min()),
+    }
+
 def main():
     start = datetime.now() - timedelta(days=365*4)
     end = datetime.now()
-    all_data = {}
+    all_data: Dict[str, pd.DataFrame] = {}
     # stocks = ["AAPL", "NVDA", "MSFT", "AVGO", "ORCL", "CRM", "CSCO", "ACN", "NOW", "IBM"]
     # stocks = ["NG=F", "BZ=F", "KC=F"]
     # stocks = ["WTI", "NATURAL_GAS", "COFFEE"]
@@ -168,17 +295,15 @@ def main():
         backtester = Backtester(ticker, start, end, 10000, display=True, periods=[5, 10, 20], commodity=False)
         backtester.run_backtesting()
         df, total_return = backtester.analyze_performance()
+        profiler.report(f"backtest_{ticker}")
         avg_returns += total_return
-        all_data[ticker] = {
-            date.strftime('%Y-%m-%d'): data 
-            for date, data in df.dropna().to_dict(orient='index').items()
-        }
+        all_data[ticker] = df
 
     avg_returns = avg_returns / len(stocks)
     print(f"\nAverage returns: {avg_returns:.2f}%")
 
-    with open(f'{Path("./sattern/src/backtesting_results")}/{save_name}.json', 'w') as f:
-        json.dump(all_data, f)
+    run = results.append_run(save_name, all_data, {"start": start.isoformat(), "end": end.isoformat(), "periods": [5, 10, 20]})
+    print(f"Results saved to {results.run_path(save_name, run)}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
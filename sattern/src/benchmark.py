@@ -0,0 +1,324 @@
+"""Offline benchmarks of the signal, backtest and I/O hot paths on seeded synthetic data."""
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import warnings
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+from sattern.src import api, process, store, news, insider, signal_cache
+from sattern.src.cache import cache_manager
+from sattern.src.backtester import Backtester
+
+BASELINE_PATH = Path("./sattern/results/benchmark_baseline.json")
+# A benchmark fails when it is this much slower than its baseline, after scaling for the speed of the machine. The
+# run also fails when the geometric mean over all benchmarks is AGGREGATE_TOLERANCE slower, which catches a slowdown
+# spread thinly over many of them
+TOLERANCE = 0.5
+AGGREGATE_TOLERANCE = 0.15
+# Benchmarks faster than this are compared as if they took this long. Below ~1ms scheduling and caches swing a
+# single benchmark by 1.5x from run to run, so only a slowdown past the floor counts
+NOISE_FLOOR = 0.001
+# The suites run this many times and each benchmark is the median of its runs, a baseline takes more
+REPEATS = 3
+BASELINE_REPEATS = 9
+HISTORY_LENGTHS = [1000, 2500, 5000]
+PERIODS = [5, 10, 20]
+# Only practical with the fft matching mode
+LONG_PERIODS = [60, 120]
+BACKTEST_YEARS = [1, 3, 5]
+TICKER = "SYN"
+
+def synthetic_prices(n: int, seed: int = 0, start_price: float = 100.0, mu: float = 0.05, sigma: float = 0.3) -> pd.DataFrame:
+    # Geometric Brownian motion over the n business days up to today, newest first like api.get_prices
+    rng = np.random.default_rng(seed)
+    dt = 1 / 252
+    log_returns = (mu - sigma**2 / 2) * dt + sigma * np.sqrt(dt) * rng.standard_normal(n - 1)
+    prices = start_price * np.exp(np.concatenate(([0.0], np.cumsum(log_returns))))
+    volume = rng.integers(100_000, 10_000_000, n).astype(float)
+    index = pd.bdate_range(end=pd.Timestamp.now(tz=timezone.utc).normalize(), periods=n, name="date").as_unit("ns")
+    return pd.DataFrame({"prices": np.round(prices, 2), "volume": volume}, index=index)[::-1]
+
+def synthetic_news(ticker: str, dates: pd.DatetimeIndex, per_day: int = 3, seed: int = 0) -> Dict:
+    # NEWS_SENTIMENT feed with per_day articles on each date, rating ticker and a couple of other tickers. Latest first
+    rng = np.random.default_rng(seed)
+    labels = ["Bearish", "Somewhat-Bearish", "Neutral", "Somewhat-Bullish", "Bullish"]
+    others = ["AAA", "BBB", "CCC", "DDD"]
+    feed = []
+    for date in pd.DatetimeIndex(dates).sort_values(ascending=False):
+        for i in range(per_day):
+            published = date + timedelta(hours=int(rng.integers(0, 24)), minutes=int(rng.integers(0, 60)))
+            ratings = []
+            for rated in [ticker, *rng.choice(others, size=2, replace=False)]:
+                score = float(np.clip(rng.normal(0.05, 0.25), -1, 1))
+                ratings.append({
+                    "ticker": str(rated),
+                    "relevance_score": f"{rng.uniform(0.05, 1):.6f}",
+                    "ticker_sentiment_score": f"{score:.6f}",
+                    "ticker_sentiment_label": labels[min(int((score + 1) / 2 * len(labels)), len(labels) - 1)],
+                })
+            feed.append({
+                "title": f"{ticker} article {len(feed)}",
+                "url": f"https://example.com/{ticker}/{len(feed)}",
+                "time_published": published.strftime("%Y%m%dT%H%M%S"),
+                "summary": "Synthetic article",
+                "ticker_sentiment": ratings,
+            })
+    feed.sort(key=lambda article: article["time_published"], reverse=True)
+    return {"items": str(len(feed)), "feed": feed}
+
+def synthetic_insider(dates: pd.DatetimeIndex, count: int, seed: int = 0) -> pd.DataFrame:
+    # INSIDER_TRANSACTIONS rows as returned by api.get_insider_transactions, on random dates
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "date": pd.DatetimeIndex(dates)[rng.integers(0, len(dates), count)],
+        "acquisition_or_disposal": rng.choice(["A", "D"], size=count),
+        "shares": rng.integers(100, 50_000, count).astype(float),
+        "share_price": np.round(rng.uniform(10, 200, count), 2),
+    })
+
+class offline_fetcher():
+    # Stands in for fetcher.fetcher so nothing in a benchmark can reach the network
+    def get_json(self, url: str) -> Dict:
+        raise RuntimeError(f"benchmarks run offline, tried to fetch {url.split('&apikey')[0]}")
+
+    def map(self, fn: Callable, items: List) -> List:
+        return [fn(item) for item in items]
+
+def seconds_per_call(fn: Callable[[], object], repeat: int = 5, min_time: float = 0.1) -> float:
+    # Best of repeat rounds, each round calls fn often enough to take about min_time
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    number = max(1, int(min_time / max(first, 1e-9)))
+    best = first
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def calibrate() -> float:
+    # Fixed numpy and interpreter workload. Results are compared relative to it so a baseline recorded on one
+    # machine still means something on another
+    data = np.random.default_rng(0).standard_normal(200_000)
+    def work():
+        np.sort(data)
+        sum(i * i for i in range(50_000))
+    return seconds_per_call(work, repeat=10, min_time=0.2)
+
+def record(results: List[Dict], name: str, seconds: float, items: float, unit: str):
+    results.append({"name": name, "seconds": seconds, "throughput": items / seconds, "unit": unit})
+
+def median_results(runs: List[List[Dict]]) -> List[Dict]:
+    # Each benchmark of repeated runs of the suites at its median time
+    by_name = [{result["name"]: result for result in run} for run in runs]
+    results: List[Dict] = []
+    for result in runs[0]:
+        seconds = float(np.median([run[result["name"]]["seconds"] for run in by_name]))
+        record(results, result["name"], seconds, result["throughput"] * result["seconds"], result["unit"])
+    return results
+
+def bench_sattern(results: List[Dict], lengths: List[int]):
+    # Per call latency of process.sattern and process.sattern_multi on the latest window of the history
+    for n in lengths:
+        df = synthetic_prices(n, seed=n)
+        for period in PERIODS:
+            record(results, f"sattern/n={n}/period={period}", seconds_per_call(lambda: process.sattern(df["prices"], period, 2)), n, "bars/s")
+        for period in [*PERIODS, *LONG_PERIODS]:
+            record(results, f"sattern_fft/n={n}/period={period}", seconds_per_call(lambda: process.sattern(df["prices"], period, 2, mode="fft")), n, "bars/s")
+        prices = df["prices"].to_numpy(dtype=float)
+        record(results, f"sattern_multi/n={n}/periods={len(PERIODS)}", seconds_per_call(lambda: process.sattern_multi(prices, PERIODS)), n, "bars/s")
+
+def bench_signals(results: List[Dict], lengths: List[int]):
+    # Building the news and insider indexes and querying them for every trading day
+    for n in lengths:
+        dates = synthetic_prices(n, seed=n).index[::-1]
+        news_data = synthetic_news(TICKER, dates, seed=n)
+        record(results, f"news_index/days={n}", seconds_per_call(lambda: news.news_index(news_data), repeat=3), len(news_data["feed"]), "articles/s")
+        index = news.news_index(news_data)
+        record(results, f"news_actions/days={n}", seconds_per_call(lambda: index.actions(TICKER, dates)), n, "days/s")
+
+        transactions = synthetic_insider(dates, n // 2, seed=n)
+        record(results, f"insider_index/days={n}", seconds_per_call(lambda: insider.insider_index(transactions)), len(transactions), "transactions/s")
+        flows = insider.insider_index(transactions)
+        record(results, f"insider_actions/days={n}", seconds_per_call(lambda: flows.actions(dates)), n, "days/s")
+
+def seed_cache(ticker: str, prices: pd.DataFrame, seed: int = 0):
+    # Put synthetic news and insider transactions for ticker in the current api cache, as if they had been fetched
+    dates = prices.index[::-1]
+    cache = api.get_cache()
+    cache.put(api.cache_key(ticker, "news"), synthetic_news(ticker, dates, seed=seed), api.data_path(ticker, "news"), api.write_json, api.CACHE_TTL)
+    cache.put(api.cache_key(ticker, "insider_transactions"), synthetic_insider(dates, len(dates) // 2, seed=seed),
+              api.data_path(ticker, "insider_transactions"), api.write_insider_transactions, api.CACHE_TTL)
+
+def bench_backtest(results: List[Dict], years_list: List[int]):
+    # End to end Backtester.run_backtesting over multi year windows, including the 2 year lookback of each day
+    for years in years_list:
+        prices = synthetic_prices(252 * (years + 2) + 20, seed=years)
+        ticker = f"{TICKER}{years}"
+        seed_cache(ticker, prices, seed=years)
+        end = datetime.now()
+        start = end - timedelta(days=365 * years)
+
+        def run():
+            backtester = Backtester(ticker, start, end, 10000, display=False, periods=PERIODS, prices=prices)
+            backtester.run_backtesting()
+            return backtester
+        days = len(run().portfolio_values)
+        record(results, f"backtest/years={years}", seconds_per_call(run, repeat=2, min_time=0), days, "days/s")
+
+        # A rerun that only changes position sizing, every sattern score comes from the signal cache
+        signal_cache.enable()
+        try:
+            run()
+            record(results, f"backtest_cached/years={years}", seconds_per_call(run, repeat=2, min_time=0), days, "days/s")
+        finally:
+            signal_cache.disable()
+
+def bench_io(results: List[Dict], lengths: List[int]):
+    # Loads through the api cache (cold reads the file, warm hits the in-process LRU) and the price store
+    for n in lengths:
+        prices = synthetic_prices(n, seed=n)
+        ticker = f"{TICKER}IO{n}"
+        seed_cache(ticker, prices, seed=n)
+        store.write(ticker, prices)
+        root = api.get_cache().root
+
+        def cold_news():
+            api.set_cache(cache_manager(root))
+            return api.load_cached(ticker, "news", api.read_json)
+        def cold_insider():
+            api.set_cache(cache_manager(root))
+            return api.load_cached(ticker, "insider_transactions", api.read_insider_transactions)
+        record(results, f"cache_news_cold/days={n}", seconds_per_call(cold_news, repeat=3), n, "days/s")
+        record(results, f"cache_insider_cold/days={n}", seconds_per_call(cold_insider, repeat=3), n // 2, "transactions/s")
+        record(results, f"cache_news_warm/days={n}", seconds_per_call(lambda: api.load_cached(ticker, "news", api.read_json)), n, "days/s")
+        record(results, f"store_read/n={n}", seconds_per_call(lambda: store.read_frame(ticker)), n, "bars/s")
+
+def run_all(quick: bool = False, only: str = None) -> List[Dict]:
+    # Runs in a scratch directory, so the relative data paths of api and store never touch the real cache. Progress
+    # prints and numpy warnings of the code under test are dropped
+    lengths = HISTORY_LENGTHS[:1] if quick else HISTORY_LENGTHS
+    years_list = BACKTEST_YEARS[:1] if quick else BACKTEST_YEARS
+    suites: List[Tuple[str, Callable[[List[Dict]], None]]] = [
+        ("sattern", lambda results: bench_sattern(results, lengths)),
+        ("signals", lambda results: bench_signals(results, lengths)),
+        ("backtest", lambda results: bench_backtest(results, years_list)),
+        ("io", lambda results: bench_io(results, lengths)),
+    ]
+    results: List[Dict] = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        (Path(scratch) / "sattern/src/data").mkdir(parents=True)
+        api.set_cache(cache_manager(Path("./sattern/src/data")))
+        api.set_fetcher(offline_fetcher())
+        # Matching is what is measured, the signal cache is only turned on for the backtest_cached runs
+        signal_cache_enabled = signal_cache.enabled()
+        signal_cache.disable()
+        try:
+            for name, suite in suites:
+                if only is None or only == name:
+                    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+                        warnings.simplefilter("ignore", RuntimeWarning)
+                        suite(results)
+        finally:
+            api.set_cache(None)
+            api.set_fetcher(None)
+            if signal_cache_enabled:
+                signal_cache.enable()
+            os.chdir(cwd)
+    return results
+
+def compare(results: List[Dict], calibration: float, baseline: Dict, tolerance: float, aggregate_tolerance: float = AGGREGATE_TOLERANCE) -> List[str]:
+    # Benchmarks that got slower than baseline * (1 + tolerance), scaled by how fast this machine ran calibrate(),
+    # and the geometric mean of all of them against 1 + aggregate_tolerance. Times are raised to NOISE_FLOOR first
+    scale = calibration / baseline["calibration"]
+    regressions = []
+    ratios = []
+    for result in results:
+        base_seconds = baseline["results"].get(result["name"])
+        if base_seconds is None:
+            continue
+        ratio = max(result["seconds"], NOISE_FLOOR) / max(base_seconds * scale, NOISE_FLOOR)
+        result["vs_baseline"] = ratio
+        ratios.append(ratio)
+        if ratio > 1 + tolerance:
+            regressions.append(f"{result['name']} is {ratio:.2f}x its baseline ({result['seconds'] * 1000:.2f}ms)")
+    mean_ratio = float(np.exp(np.mean(np.log(ratios)))) if ratios else 1.0
+    if mean_ratio > 1 + aggregate_tolerance:
+        regressions.append(f"the geometric mean of {len(ratios)} benchmarks is {mean_ratio:.2f}x the baseline")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="record this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--aggregate-tolerance", type=float, default=AGGREGATE_TOLERANCE)
+    parser.add_argument("--repeats", type=int, help=f"runs of the suites to take the median of (default {REPEATS}, {BASELINE_REPEATS} with --save-baseline)")
+    parser.add_argument("--quick", action="store_true", help="smallest history length and backtest only")
+    parser.add_argument("--only", choices=["sattern", "signals", "backtest", "io"])
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+    baseline_path, output_path = args.baseline.absolute(), args.output and args.output.absolute()
+
+    # Calibrated around every run. The medians of the calibrations and of each benchmark describe the same typical
+    # state of the machine, so a recorded baseline and a later run compare like for like
+    repeats = args.repeats or (BASELINE_REPEATS if args.save_baseline else REPEATS)
+    calibrations = [calibrate()]
+    runs = []
+    for _ in range(repeats):
+        runs.append(run_all(args.quick, args.only))
+        calibrations.append(calibrate())
+    calibration = float(np.median(calibrations))
+    results = median_results(runs)
+
+    regressions = []
+    missing_baseline = False
+    if args.save_baseline:
+        baseline = {"calibration": calibration, "results": {}}
+        if baseline_path.exists():
+            with open(baseline_path, 'r') as f:
+                baseline = json.load(f)
+            # Keep entries of benchmarks that were not part of this run, rescaled to this run's calibration
+            scale = calibration / baseline["calibration"]
+            baseline = {"calibration": calibration, "results": {name: seconds * scale for name, seconds in baseline["results"].items()}}
+        baseline["results"].update({result["name"]: result["seconds"] for result in results})
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(baseline, f, indent=4)
+    elif baseline_path.exists():
+        with open(baseline_path, 'r') as f:
+            regressions = compare(results, calibration, json.load(f), args.tolerance, args.aggregate_tolerance)
+    else:
+        # Nothing to compare against fails the check, so a missing baseline is never mistaken for a pass
+        missing_baseline = True
+
+    print(f"{'Benchmark':<36} {'Latency (ms)':>13} {'Throughput':>28} {'vs baseline':>12}")
+    print("-" * 92)
+    for result in results:
+        vs_baseline = f"{result['vs_baseline']:.2f}x" if "vs_baseline" in result else "-"
+        print(f"{result['name']:<36} {result['seconds'] * 1000:>13.3f} {result['throughput']:>13,.0f} {result['unit']:<14} {vs_baseline:>12}")
+
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump({"calibration": calibration, "results": results}, f, indent=4)
+
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if missing_baseline:
+        print(f"No baseline at {baseline_path}, run with --save-baseline to record one")
+    sys.exit(1 if regressions or missing_baseline else 0)
+
+if __name__ == "__main__":
+    main()
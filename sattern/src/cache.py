@@ -0,0 +1,136 @@
+"""Manifest backed cache for API data, with an in-process LRU in front of it."""
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+# Returned on a cache miss, since None is a valid cached value (a ticker without insider transactions)
+MISSING = object()
+# Registrations kept in memory before the manifest is written out, bounds what a killed process loses
+FLUSH_EVERY = 256
+
+class cache_manager():
+    # The manifest maps each key ("news/ERJ") to the file holding it, when it was fetched and how long it stays
+    # valid, so a lookup never has to probe the disk for date stamped names. Parsed values are kept in a bounded LRU,
+    # repeated lookups in one process only read the file once.
+    # New entries are batched and written on flush (api flushes at exit), not once per register. The lock only
+    # guards the manifest and the LRU, files are read and written outside it so concurrent loads do not queue
+    def __init__(self, root: Path = Path("./sattern/src/data"), max_entries: int = 128):
+        self.root = root
+        self.manifest_path = root / "manifest.json"
+        self.max_entries = max_entries
+        self.memory: "OrderedDict[str, Tuple[Any, datetime]]" = OrderedDict()
+        self.lock = threading.RLock()
+        self.manifest: Dict[str, Dict] = self._read_manifest()
+        # Keys registered since the manifest was last written
+        self.pending: Set[str] = set()
+
+    def _read_manifest(self) -> Dict[str, Dict]:
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_manifest(self):
+        # Merge this process's new entries into the entries other processes may have written since it loaded the
+        # manifest
+        manifest = self._read_manifest()
+        manifest.update({key: self.manifest[key] for key in self.pending})
+        self.manifest = {key: entry for key, entry in manifest.items() if Path(entry["file"]).exists()}
+        self.pending.clear()
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_name(f"{self.manifest_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    def recall(self, key: str) -> Any:
+        # In-process value of key, or MISSING
+        with self.lock:
+            if key not in self.memory:
+                return MISSING
+            value, expires = self.memory[key]
+            if datetime.now(timezone.utc) >= expires:
+                del self.memory[key]
+                return MISSING
+            self.memory.move_to_end(key)
+            return value
+
+    def remember(self, key: str, value: Any, ttl: timedelta):
+        with self.lock:
+            self.memory[key] = (value, datetime.now(timezone.utc) + ttl)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def register(self, key: str, file_path: Path, ttl: timedelta, fetched: datetime = None):
+        with self.lock:
+            self.manifest[key] = {
+                "file": str(file_path),
+                "fetched": (fetched or datetime.now(timezone.utc)).isoformat(),
+                "ttl": ttl.total_seconds(),
+            }
+            self.pending.add(key)
+            if len(self.pending) >= FLUSH_EVERY:
+                self._write_manifest()
+
+    def flush(self, force: bool = False):
+        # Write registered entries to the manifest, for other processes and later runs. force writes it even without
+        # new entries, which creates the manifest if there is none yet
+        with self.lock:
+            if self.pending or force:
+                self._write_manifest()
+
+    def fresh_entry(self, key: str) -> Optional[Tuple[Path, datetime]]:
+        # File of key and when it expires, if the manifest has an entry that has not expired
+        with self.lock:
+            entry = self.manifest.get(key)
+        if entry is None:
+            return None
+        expires = datetime.fromisoformat(entry["fetched"]) + timedelta(seconds=entry["ttl"])
+        if datetime.now(timezone.utc) >= expires:
+            return None
+        return Path(entry["file"]), expires
+
+    def get(self, key: str, loader: Callable[[Path], Any]) -> Any:
+        value = self.recall(key)
+        if value is not MISSING:
+            return value
+        entry = self.fresh_entry(key)
+        if entry is None or not entry[0].exists():
+            return MISSING
+        # Parsed outside the lock. Two threads missing the same key both load it, which is rare and harmless
+        file_path, expires = entry
+        value = loader(file_path)
+        self.remember(key, value, expires - datetime.now(timezone.utc))
+        return value
+
+    def put(self, key: str, value: Any, file_path: Path, writer: Callable[[Path, Any], None], ttl: timedelta):
+        # Write value to file_path, point the manifest at it and drop the file it pointed at before. The file is
+        # written next to file_path and moved into place, so readers never see it half written
+        tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        writer(tmp_path, value)
+        os.replace(tmp_path, file_path)
+        with self.lock:
+            previous = self.manifest.get(key)
+            self.register(key, file_path, ttl)
+        self.remember(key, value, ttl)
+        # The manifest knows the old file, listing the directory for it on every put is quadratic over a universe
+        if previous is not None and Path(previous["file"]) != Path(file_path):
+            Path(previous["file"]).unlink(missing_ok=True)
+
+def evict_stale_files(file_path: Path):
+    # Files named <ticker>_<name>_<YYYYMMDD>.json are replaced by the newest one. Used when files from before the
+    # manifest are registered, put drops the previous file of a key itself
+    match = re.fullmatch(r"(.+)_(\d{8})\.json", file_path.name)
+    if match is None:
+        return
+    pattern = re.compile(re.escape(match.group(1)) + r"_\d{8}\.json")
+    for old_path in file_path.parent.iterdir():
+        if old_path != file_path and pattern.fullmatch(old_path.name):
+            old_path.unlink(missing_ok=True)
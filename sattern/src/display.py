@@ -1,28 +1,64 @@
-from matplotlib import pyplot
-import matplotlib.dates as mdates
-from typing import List
+import os
+import numpy as np
 import pandas as pd
+from pathlib import Path
+from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor
+
+# Points kept per line when a chart is rendered to a file. 20 years of daily bars is ~5000
+DEFAULT_MAX_POINTS = 1500
+# Points kept per line on an interactive chart. Daily histories are drawn whole, intraday ones (millions of bars)
+# are downsampled so panning and zooming stay responsive
+INTERACTIVE_MAX_POINTS = 20000
+
+def headless() -> bool:
+    # SATTERN_HEADLESS=1 never touches a GUI backend: entry points skip interactive plots and anything that is
+    # still drawn goes through Agg
+    return os.getenv("SATTERN_HEADLESS", "") not in ("", "0")
+
+def get_pyplot():
+    # matplotlib is only imported once something is plotted
+    import matplotlib
+    if headless():
+        matplotlib.use("Agg")
+    from matplotlib import pyplot
+    return pyplot
 
 class custom_plot():
-    def __init__(self, ticker:str, prices:pd.DataFrame):
+    def __init__(self, ticker:str, prices:pd.DataFrame, to_file:bool=False, max_points:int=None):
         self.ticker:str = ticker
         # self.tickers = []
         self.prices:pd.DataFrame = prices
-        self.fig, self.ax = pyplot.subplots()
+        # Lines longer than max_points are downsampled with LTTB
+        if max_points is None:
+            max_points = DEFAULT_MAX_POINTS if to_file else INTERACTIVE_MAX_POINTS
+        self.max_points:int = max_points
+        # Width of a bar in days, 1 for daily prices
+        spacing = np.diff(date_nums(prices.index)) if len(prices) > 1 else np.ones(1)
+        self.bar_days: float = min(1.0, float(np.median(np.abs(spacing))))
+        if to_file or headless():
+            # A bare Figure draws with Agg and never goes through pyplot or a GUI backend
+            from matplotlib.figure import Figure
+            self.fig = Figure()
+            self.ax = self.fig.subplots()
+        else:
+            self.fig, self.ax = get_pyplot().subplots()
         self.plot(prices, "prices", "blue")
         self.ax.set_title(f"{ticker} prices")
 
     def highlight(self, data_to_highlight: pd.DataFrame, period:int, max_diff:int, color:str):
+        from matplotlib.collections import PolyCollection
+        from matplotlib.colors import to_rgba
+
+        # All similar periods as one collection of full height spans instead of an artist per period
         df = data_to_highlight.dropna(axis=0, inplace=False)
-        for i in range(len(df.index)):
-            if not pd.isna(df.iloc[i]):
-                end_date = df.index[i] + pd.Timedelta(days=period)
-                self.ax.axvspan(
-                    df.index[i],
-                    end_date,
-                    color=color,
-                    alpha=( (max_diff - abs(df.iloc[i])) / max_diff )**20/3 + 0.1
-                )
+        if len(df) > 0:
+            starts = date_nums(df.index)
+            ends = starts + period * self.bar_days
+            spans = [[(start, 0), (start, 1), (end, 1), (end, 0)] for start, end in zip(starts, ends)]
+            alphas = ( (max_diff - np.abs(df.to_numpy(dtype=float))) / max_diff )**20/3 + 0.1
+            colors = [to_rgba(color, alpha) for alpha in alphas]
+            self.ax.add_collection(PolyCollection(spans, facecolors=colors, edgecolors="none", transform=self.ax.get_xaxis_transform()), autolim=False)
 
         # Highlight the final period
         self.ax.axvspan(
@@ -33,11 +69,18 @@ class custom_plot():
         )
 
     def plot(self, data_to_plot:pd.DataFrame, metric:str, color:str):
+        import matplotlib.dates as mdates
         df = data_to_plot.dropna(axis=0, inplace=False)
+        if self.max_points is not None and len(df) > self.max_points:
+            values = np.asarray(df.values, dtype=float).reshape(len(df), -1)[:, 0]
+            df = df.iloc[lttb(date_nums(df.index), values, self.max_points)]
         self.ax.plot(df.index, df.values, color=color, label=metric)
 
-        # Format x-axis as dates
-        self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
+        # Format x-axis as dates, intraday charts also label days and times
+        if self.bar_days < 1:
+            self.ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(self.ax.xaxis.get_major_locator()))
+        else:
+            self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m'))
         self.fig.autofmt_xdate()
 
         self.ax.set_xlabel('Date')
@@ -45,4 +88,54 @@ class custom_plot():
 
     def show(self):
         self.ax.legend()
-        pyplot.show()
\ No newline at end of file
+        get_pyplot().show()
+
+    def save(self, path: Path):
+        # A fixed legend position, searching for the "best" one tests every highlight span and dominates render time
+        self.ax.legend(loc="upper left")
+        self.fig.savefig(path)
+
+def date_nums(index: pd.DatetimeIndex) -> np.ndarray:
+    # matplotlib date numbers (days since 1970) straight from the int64 timestamps, mdates.date2num goes through
+    # a Python datetime per point for tz-aware indexes
+    return pd.DatetimeIndex(index).as_unit("ns").asi8 / (24 * 60 * 60 * 1e9)
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    # Largest-Triangle-Three-Buckets: indices of threshold points that keep the visual shape of the series.
+    # The first and last points are always kept, every bucket in between keeps the point that makes the largest
+    # triangle with the previously kept point and the average of the next bucket
+    order = np.argsort(x, kind="stable")
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return order
+    x, y = np.asarray(x, dtype=float)[order], np.asarray(y, dtype=float)[order]
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return order[selected]
+
+def render_chart(ticker: str, prices: pd.Series, path: Path, p_sattern: pd.DataFrame = None, period: int = 10, max_diff: int = 2, max_points: int = DEFAULT_MAX_POINTS) -> Path:
+    # The fund manager chart (prices, similar periods and the sattern prediction) written to path with Agg
+    graph = custom_plot(ticker, prices, to_file=True, max_points=max_points)
+    if p_sattern is not None and "highlight" in p_sattern:
+        graph.highlight(p_sattern["highlight"], period, max_diff, "yellow")
+        graph.plot(p_sattern["sattern"], "sattern", "green")
+    graph.save(path)
+    return Path(path)
+
+def render_charts(charts: List[Dict], max_workers: int = 1) -> List[Path]:
+    # Render many charts, each a dict of render_chart arguments. With max_workers > 1 they are spread over processes
+    if max_workers <= 1:
+        return [render_chart(**chart) for chart in charts]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(render_chart, **chart) for chart in charts]
+        return [future.result() for future in futures]
@@ -0,0 +1,175 @@
+"""Run backtests for many tickers in parallel."""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+import numpy as np
+import pandas as pd
+import os
+from sattern.src import api, profiler, results, trader
+from sattern.src.backtester import Backtester
+
+# Layout of each ticker in the shared block: (first row, number of rows)
+Layout = Dict[str, Tuple[int, int]]
+
+class shared_prices():
+    # Price histories of many tickers packed into one shared memory block. The first half of the block holds the
+    # dates as int64 nanoseconds, the second half the closing prices as float64, tickers back to back in each half
+    def __init__(self, shm: shared_memory.SharedMemory, layout: Layout, total_rows: int):
+        self.shm = shm
+        self.layout = layout
+        self.dates = np.ndarray((total_rows,), dtype=np.int64, buffer=shm.buf)
+        self.prices = np.ndarray((total_rows,), dtype=np.float64, buffer=shm.buf, offset=total_rows * 8)
+
+    @classmethod
+    def create(cls, prices: Dict[str, pd.DataFrame]) -> "shared_prices":
+        layout: Layout = {}
+        total_rows = 0
+        for ticker, df in prices.items():
+            layout[ticker] = (total_rows, len(df))
+            total_rows += len(df)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(total_rows * 16, 1))
+        block = cls(shm, layout, total_rows)
+        for ticker, df in prices.items():
+            start, length = layout[ticker]
+            block.dates[start:start + length] = df.index.as_unit("ns").asi8
+            block.prices[start:start + length] = df["prices"].to_numpy(dtype=float)
+        return block
+
+    @classmethod
+    def attach(cls, name: str, layout: Layout) -> "shared_prices":
+        total_rows = sum(length for _, length in layout.values())
+        return cls(shared_memory.SharedMemory(name=name), layout, total_rows)
+
+    def frame(self, ticker: str) -> pd.DataFrame:
+        # DataFrame over the shared arrays, in the same newest first order as api.get_prices
+        start, length = self.layout[ticker]
+        index = pd.DatetimeIndex(self.dates[start:start + length].view("datetime64[ns]"), name="date").tz_localize("UTC")
+        return pd.DataFrame({"prices": self.prices[start:start + length]}, index=index, copy=False)
+
+    def close(self):
+        # Views into the block have to be dropped before the mapping can close
+        del self.dates, self.prices
+        self.shm.close()
+
+# Each worker process attaches to the shared block once and keeps it for its lifetime
+_worker_prices: shared_prices = None
+
+def _attach_worker(name: str, layout: Layout, profiler_settings: Dict):
+    global _worker_prices
+    _worker_prices = shared_prices.attach(name, layout)
+    # Forked workers start with a copy of whatever the parent had recorded
+    profiler.configure(profiler_settings)
+    profiler.reset()
+
+def _run_ticker(ticker: str, start: datetime, end: datetime, init_capital: float, periods: List[int], commodity: bool) -> Tuple[str, pd.DataFrame, float, Dict[str, Dict]]:
+    backtester = Backtester(ticker, start, end, init_capital, display=False, periods=periods, commodity=commodity, prices=_worker_prices.frame(ticker))
+    backtester.run_backtesting()
+    df, total_return = backtester.analyze_performance()
+    # What this ticker recorded goes back to the parent, which merges every worker into one report
+    profile = profiler.summary()
+    profiler.reset()
+    return ticker, df, total_return, profile
+
+def _signal_ticker(ticker: str, start: datetime, end: datetime, periods: List[int], commodity: bool) -> Tuple[str, pd.DataFrame, Dict[str, Dict]]:
+    # Phase one of the backtest only, the portfolio is replayed in the parent over every ticker at once
+    backtester = Backtester(ticker, start, end, 0, display=False, periods=periods, commodity=commodity, prices=_worker_prices.frame(ticker))
+    signals = backtester.signal_matrix()
+    profile = profiler.summary()
+    profiler.reset()
+    return ticker, signals, profile
+
+def _load(stocks: List[str], start: datetime, end: datetime, commodity: bool) -> Dict[str, pd.DataFrame]:
+    # Load (and cache) every ticker up front so workers only read from disk and shared memory
+    prices: Dict[str, pd.DataFrame] = {}
+    with profiler.span("farm.load"):
+        for ticker in stocks:
+            prices[ticker] = api.get_commodity_prices(ticker) if commodity else api.get_prices(ticker)
+            if not commodity:
+                api.get_news(ticker, start, end)
+                api.get_insider_transactions(ticker)
+        # Workers read the manifest from disk
+        api.get_cache().flush()
+    return prices
+
+def run_farm(stocks: List[str], start: datetime, end: datetime, init_capital: float, periods: List[int], commodity: bool = False, max_workers: int = None) -> Tuple[Dict[str, pd.DataFrame], float]:
+    prices = _load(stocks, start, end, commodity)
+    with profiler.span("farm.shared_memory"):
+        block = shared_prices.create(prices)
+    all_data: Dict[str, pd.DataFrame] = {}
+    returns: Dict[str, float] = {}
+    try:
+        with profiler.span("farm.backtests"), ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_attach_worker, initargs=(block.shm.name, block.layout, profiler.settings())) as pool:
+            futures = [pool.submit(_run_ticker, ticker, start, end, init_capital, periods, commodity) for ticker in stocks]
+            for future in as_completed(futures):
+                ticker, data, total_return, profile = future.result()
+                all_data[ticker] = data
+                returns[ticker] = total_return
+                profiler.merge(profile)
+    finally:
+        block.close()
+        block.shm.unlink()
+
+    # Keep the tickers in the order they were requested
+    all_data = {ticker: all_data[ticker] for ticker in stocks}
+    avg_returns = sum(returns.values()) / len(stocks)
+    return all_data, avg_returns
+
+def run_portfolio(stocks: List[str], start: datetime, end: datetime, init_capital: float, periods: List[int], commodity: bool = False, max_workers: int = None, **sizing) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # One portfolio holding every ticker on a shared cash balance. The signal matrices of the tickers are computed in
+    # parallel like run_farm, aligned to the calendar of days any ticker traded (a ticker without a bar on a day does
+    # not trade and has no signal) and replayed together with trader.replay_portfolio.
+    # sizing is passed to trader.combine_signal_scores, budget (per trade) defaults to an equal share of init_capital.
+    # Returns (Portfolio Value, Cash, Daily Return per day, shares held of every ticker per day)
+    prices = _load(stocks, start, end, commodity)
+    with profiler.span("farm.shared_memory"):
+        block = shared_prices.create(prices)
+    signals: Dict[str, pd.DataFrame] = {}
+    try:
+        with profiler.span("farm.signals"), ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_attach_worker, initargs=(block.shm.name, block.layout, profiler.settings())) as pool:
+            futures = [pool.submit(_signal_ticker, ticker, start, end, periods, commodity) for ticker in stocks]
+            for future in as_completed(futures):
+                ticker, signal_matrix, profile = future.result()
+                signals[ticker] = signal_matrix
+                profiler.merge(profile)
+    finally:
+        block.close()
+        block.shm.unlink()
+
+    with profiler.span("farm.portfolio"):
+        dates = pd.DatetimeIndex(sorted(set().union(*(signal_matrix.index for signal_matrix in signals.values()))))
+        curr_prices = trader.align_prices(prices, dates)[stocks].to_numpy(dtype=float)
+        # days x tickers x signals, NaN where a ticker has fewer signals or no bar
+        n_signals = max((signal_matrix.shape[1] for signal_matrix in signals.values()), default=0)
+        scores = np.full((len(dates), len(stocks), n_signals), np.nan)
+        for i, ticker in enumerate(stocks):
+            rows = dates.get_indexer(signals[ticker].index)
+            scores[rows, i, :signals[ticker].shape[1]] = signals[ticker].to_numpy(dtype=float)
+
+        sizing.setdefault("budget", init_capital / max(len(stocks), 1))
+        action_codes, quantities = trader.combine_signal_scores(scores, curr_prices, **sizing)
+        _, cash, stock = trader.replay_portfolio(action_codes, quantities, curr_prices, init_capital)
+        # Positions are valued at the last price seen, before a ticker's first bar it holds nothing
+        last_prices = pd.DataFrame(curr_prices).ffill().to_numpy()
+        portfolio_values = cash + np.nansum(stock * last_prices, axis=1)
+
+    performance_df = pd.DataFrame({"Portfolio Value": portfolio_values, "Cash": cash}, index=dates.rename("Date"))
+    performance_df["Daily Return"] = performance_df["Portfolio Value"].pct_change()
+    return performance_df, pd.DataFrame(stock, index=dates.rename("Date"), columns=stocks)
+
+def main():
+    start = datetime.now() - timedelta(days=365*4)
+    end = datetime.now()
+    stocks = ["AAPL", "NVDA", "MSFT", "AVGO", "ORCL", "CRM", "CSCO", "ACN", "NOW", "IBM"]
+    save_name = "Testing"
+
+    all_data, avg_returns = run_farm(stocks, start, end, 10000, periods=[5, 10, 20], commodity=False)
+    print(f"\nAverage returns: {avg_returns:.2f}%")
+    profiler.report(f"farm_{save_name}")
+
+    run = results.append_run(save_name, all_data, {"start": start.isoformat(), "end": end.isoformat(), "periods": [5, 10, 20]})
+    print(f"Results saved to {results.run_path(save_name, run)}")
+
+if __name__ == "__main__":
+    main()
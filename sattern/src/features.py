@@ -0,0 +1,130 @@
+"""Point in time feature frame of prices, insider flows and news sentiment on the trading calendar."""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from sattern.src import api, news, insider, process, trader, profiler
+
+FEATURE_PATH = Path("./sattern/src/data/features")
+# Trailing window of the news sentiment, same as process_news
+NEWS_WINDOW = timedelta(days=30)
+
+# One row per bar of the price history, oldest first. Every column only uses what was known before the bar:
+#   prices, volume            the bar itself
+#   news_sentiment            relevance weighted sentiment of articles published in the 30 days before the bar
+#   insider_shares/money      net insider flows of every transaction dated before the bar
+#   news, insider_transactions signal_score of the news and insider actions (what Backtester trades on)
+# insider_transactions is left out for tickers without any transactions, like Backtester.context_signals always did.
+# A frame is saved like the price store (a directory of .npy columns, memory mapped on read) with meta.json written
+# last, holding a fingerprint of the inputs. A frame whose inputs changed is rebuilt instead of read
+
+def frame_path(name: str) -> Path:
+    return FEATURE_PATH / name
+
+def fingerprint(ticker: str, prices: pd.DataFrame, news_data: Optional[Dict], insider_transactions: Optional[pd.DataFrame]) -> str:
+    # Hash of everything build reads: the bars, the publish time and ratings of articles about ticker and the
+    # insider transactions. Serializing the whole news payload instead would cost more than reading the frame
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(prices.index.as_unit("ns").asi8.tobytes())
+    for column in prices.columns:
+        digest.update(prices[column].to_numpy(dtype=float).tobytes())
+    for article in [] if news_data is None else news_data["feed"]:
+        ratings = [(rating["relevance_score"], rating["ticker_sentiment_score"]) for rating in article["ticker_sentiment"] if rating["ticker"] == ticker]
+        digest.update(repr((article["time_published"], ratings)).encode())
+    if insider_transactions is not None:
+        digest.update(pd.util.hash_pandas_object(insider_transactions, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def build(ticker: str, prices: pd.DataFrame, news_data: Optional[Dict] = None, insider_transactions: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    # As-of join of every source onto the bars of prices (laid out like api.get_prices) in one vectorized pass:
+    # each source is sorted by time once and every bar finds its position with a binary search
+    calendar = prices.index[::-1]
+    columns: Dict[str, np.ndarray] = {column: prices[column].to_numpy(dtype=float)[::-1] for column in prices.columns}
+    sentiment = news.news_index(news_data).weighted_sentiment(ticker, calendar, NEWS_WINDOW)
+    flows = insider.insider_index(insider_transactions)
+    shares, money = flows.flows(calendar)
+    columns["news_sentiment"] = sentiment
+    columns["insider_shares"] = shares
+    columns["insider_money"] = money
+    columns["news"] = scores(process.news_signals(sentiment))
+    if len(flows.dates) > 0:
+        columns["insider_transactions"] = scores(process.insider_signals(shares, money))
+    return pd.DataFrame(columns, index=calendar.rename("date"))
+
+def scores(actions: np.ndarray) -> np.ndarray:
+    # trader.signal_score of an array of actions. Scores are halves, float32 holds them exactly
+    return pd.Series(actions).map(trader.SIGNAL_SCORES).fillna(0).to_numpy(dtype=np.float32)
+
+def save(name: str, frame: pd.DataFrame, key: str):
+    path = frame_path(name)
+    path.mkdir(parents=True, exist_ok=True)
+    columns = {column: frame[column].to_numpy() for column in frame.columns}
+    columns["date"] = frame.index.as_unit("ns").asi8
+    for column, values in columns.items():
+        tmp_path = path / f"{column}.npy.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp_path, path / f"{column}.npy")
+    tmp_path = path / f"meta.json.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"fingerprint": key, "columns": list(frame.columns), "rows": len(frame)}, f, indent=4)
+    os.replace(tmp_path, path / "meta.json")
+
+def load(name: str, key: str = None) -> Optional[pd.DataFrame]:
+    # Saved frame of name, None if there is none, it was not saved completely or (given key) its inputs changed
+    path = frame_path(name)
+    try:
+        with open(path / "meta.json", 'r') as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if key is not None and meta["fingerprint"] != key:
+        return None
+    try:
+        columns = {column: np.load(path / f"{column}.npy", mmap_mode="r") for column in ["date", *meta["columns"]]}
+    except (FileNotFoundError, ValueError):
+        return None
+    if any(len(values) != meta["rows"] for values in columns.values()):
+        return None
+    index = pd.DatetimeIndex(np.asarray(columns.pop("date")).view("datetime64[ns]"), name="date").tz_localize("UTC")
+    return pd.DataFrame(columns, index=index, copy=False)
+
+def feature_frame(ticker: str, prices: pd.DataFrame, news_data: Optional[Dict] = None, insider_transactions: Optional[pd.DataFrame] = None, name: str = None) -> pd.DataFrame:
+    # The saved frame if its inputs are unchanged, otherwise build and save it. name defaults to the ticker, give
+    # another one for a different calendar of the same ticker (intraday bars)
+    name = name or ticker
+    key = fingerprint(ticker, prices, news_data, insider_transactions)
+    frame = load(name, key)
+    profiler.count(f"cache.features.{'miss' if frame is None else 'hit'}")
+    if frame is None:
+        with profiler.span("features.build"):
+            frame = build(ticker, prices, news_data, insider_transactions)
+        save(name, frame, key)
+    return frame
+
+def at(frame: pd.DataFrame, dates: pd.DatetimeIndex, columns: List[str]) -> Dict[str, np.ndarray]:
+    # Rows of frame as of each date: the last bar at or before it. Dates before the first bar get NaN
+    positions = frame.index.searchsorted(pd.DatetimeIndex(dates), side="right") - 1
+    values: Dict[str, np.ndarray] = {}
+    for column in columns:
+        column_values = np.asarray(frame[column].to_numpy(), dtype=float)
+        values[column] = np.where(positions >= 0, column_values[np.maximum(positions, 0)], np.nan)
+    return values
+
+def get_features(ticker: str, start_date: datetime = None, end_date: datetime = None) -> pd.DataFrame:
+    # Feature frame of ticker from its cached prices, news and insider transactions, between start_date and
+    # end_date (default the whole price history), newest first like api.get_prices
+    end_date = end_date or datetime.now(timezone.utc)
+    start_date = start_date or end_date - timedelta(days=365 * 20)
+    prices = api.get_prices(ticker)
+    # News from a window before start_date so the first rows have their full sentiment window
+    news_data = api.get_news(ticker, start_date - NEWS_WINDOW, end_date)
+    frame = feature_frame(ticker, prices, news_data, api.get_insider_transactions(ticker))
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    start = start.tz_localize("UTC") if start.tzinfo is None else start
+    end = end.tz_localize("UTC") if end.tzinfo is None else end
+    return frame.loc[start:end].iloc[::-1]
@@ -0,0 +1,74 @@
+"""Rate limited, pooled HTTP fetching for the api module."""
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List
+
+class token_bucket():
+    # Allows requests_per_minute on average with bursts of up to capacity requests. Thread safe
+    def __init__(self, requests_per_minute: float, capacity: float = 1):
+        self.rate = requests_per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class fetcher():
+    # One pooled session shared by every request. Requests wait on the token bucket, and failed or rate limited
+    # responses are retried with exponential backoff
+    def __init__(self, requests_per_minute: float = 5, max_workers: int = 8, retries: int = 3, backoff: float = 1.0, capacity: float = 1, timeout: float = 30):
+        self.bucket = token_bucket(requests_per_minute, capacity)
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_json(self, url: str) -> Dict:
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            last_attempt = attempt == self.retries
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+            else:
+                if response.status_code == 429 or response.status_code >= 500:
+                    if last_attempt:
+                        response.raise_for_status()
+                else:
+                    response.raise_for_status()
+                    data = response.json()
+                    # Alpha Vantage answers a rate limited request with a 200 and a note instead of data
+                    if last_attempt or not is_rate_limited(data):
+                        return data
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def map(self, func: Callable, items: Iterable) -> List:
+        # Run func over items on a thread pool sized to the connection pool. Results keep the order of items
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(func, items))
+
+def is_rate_limited(data: Dict) -> bool:
+    if not isinstance(data, dict) or len(data) != 1:
+        return False
+    message = str(data.get("Note", data.get("Information", "")))
+    return "rate limit" in message.lower() or "call frequency" in message.lower()
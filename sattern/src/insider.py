@@ -0,0 +1,44 @@
+"""Point in time index over insider transactions"""
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from typing import List, Tuple
+from sattern.src import process
+
+class insider_index():
+    # Signed share and money flows of every transaction, summed per transaction date and kept as cumulative sums,
+    # so process_insider_transactions as of any date is a binary search instead of a pass over the history
+    def __init__(self, df: pd.DataFrame):
+        required_cols = ["date", "acquisition_or_disposal", "shares", "share_price"]
+        if df is None or not all(col in df.columns for col in required_cols):
+            df = pd.DataFrame(columns=required_cols)
+
+        df = df.assign(
+            shares=pd.to_numeric(df["shares"], errors="coerce"),
+            share_price=pd.to_numeric(df["share_price"], errors="coerce"),
+        )
+        signed_shares, signed_money = process.insider_flows(df)
+        dates = pd.to_datetime(df["date"], utc=True).dt.as_unit("ns").to_numpy(dtype=np.int64)
+
+        # Net flow per transaction date
+        order = np.argsort(dates, kind="stable")
+        self.dates, first = np.unique(dates[order], return_index=True)
+        shares = np.add.reduceat(signed_shares[order], first) if len(first) else np.zeros(0)
+        money = np.add.reduceat(signed_money[order], first) if len(first) else np.zeros(0)
+        self.cum_shares: np.ndarray = np.concatenate(([0.0], np.cumsum(shares)))
+        self.cum_money: np.ndarray = np.concatenate(([0.0], np.cumsum(money)))
+
+    def flows(self, dates: pd.DatetimeIndex, window: timedelta = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Net shares and money moved by transactions before each date, over the trailing window or the full history
+        dates = pd.DatetimeIndex(dates)
+        end = np.searchsorted(self.dates, dates.as_unit("ns").asi8, side="left")
+        if window is None:
+            start = np.zeros(len(dates), dtype=np.int64)
+        else:
+            start = np.searchsorted(self.dates, (dates - window).as_unit("ns").asi8, side="left")
+        return self.cum_shares[end] - self.cum_shares[start], self.cum_money[end] - self.cum_money[start]
+
+    def actions(self, dates: pd.DatetimeIndex, window: timedelta = None) -> List[str]:
+        # process_insider_transactions action as of each date
+        shares, money = self.flows(dates, window)
+        return [process.insider_signal(s, m) for s, m in zip(shares, money)]
@@ -1,18 +1,26 @@
-from openai import OpenAI
-from dotenv import load_dotenv
 import os
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import json
+import hashlib
 from pathlib import Path
 import pandas as pd
 from typing import Dict
 from sattern.src.trader import portfolio
-from openai import OpenAIError
+from sattern.src import profiler
 from datetime import datetime
-
-load_dotenv()
-
-def run_llm(ticker: str, df: pd.DataFrame, actions: Dict[str, str], portfolio: portfolio) -> Dict:
+from concurrent.futures import ThreadPoolExecutor
+
+# Sent with every request, and part of the response cache key
+LLM_PARAMS = {
+    "model": "meta/llama-3.3-70b-instruct",
+    "temperature": 0.2,
+    "top_p": 0.7,
+    "max_tokens": 1024,
+}
+# Responses stored by the hash of the prompt and LLM_PARAMS
+CACHE_PATH = Path("./sattern/src/data/llm_cache")
+
+def build_prompt(ticker: str, df: pd.DataFrame, actions: Dict[str, str], portfolio: portfolio) -> Tuple[List[Dict], List[Dict]]:
     format_rules = [{
         "type": "function",
         "function": {
@@ -82,27 +90,62 @@ def run_llm(ticker: str, df: pd.DataFrame, actions: Dict[str, str], portfolio: p
             """
         }
     ]
-
+    return messages, format_rules
+
+def get_client():
+    # openai and .env are only loaded once the LLM is actually used. LLM_BASE_URL points at any OpenAI compatible server
+    from openai import OpenAI
+    from dotenv import load_dotenv
+    load_dotenv()
+    return OpenAI(
+        base_url = os.getenv('LLM_BASE_URL', "https://integrate.api.nvidia.com/v1"),
+        api_key = os.getenv('NIM_API_KEY')
+    )
+
+def cache_key(messages: List[Dict], format_rules: List[Dict]) -> str:
+    prompt = json.dumps({"messages": messages, "tools": format_rules, **LLM_PARAMS}, sort_keys=True)
+    return hashlib.sha256(prompt.encode()).hexdigest()
+
+def cached_response(messages: List[Dict], format_rules: List[Dict]) -> Optional[Dict]:
+    # The same prompt and parameters always reuse the stored response
+    cache_file = CACHE_PATH / f"{cache_key(messages, format_rules)}.json"
+    if not cache_file.exists():
+        return None
+    profiler.count("llm.cache.hit")
+    with open(cache_file, 'r') as f:
+        return json.load(f)
+
+def run_llm(ticker: str, df: pd.DataFrame, actions: Dict[str, str], portfolio: portfolio, client = None, use_cache: bool = True) -> Dict:
+    messages, format_rules = build_prompt(ticker, df, actions, portfolio)
+    if use_cache:
+        response = cached_response(messages, format_rules)
+        if response is not None:
+            return response
+
+    # openai is only imported once a request has to be sent
+    from openai import OpenAIError
+    cache_file = CACHE_PATH / f"{cache_key(messages, format_rules)}.json"
     try:
-        client = OpenAI(
-            base_url = "https://integrate.api.nvidia.com/v1",
-            api_key = os.getenv('NIM_API_KEY')
-        )
-        completion = client.chat.completions.create(
-            model="meta/llama-3.3-70b-instruct",
-            messages=messages,
-            temperature=0.2,
-            top_p=0.7,
-            max_tokens=1024,
-            stream=False,
-            tools=format_rules,
-            tool_choice="auto"
-        )
+        if client is None:
+            client = get_client()
+        with profiler.span("llm"):
+            completion = client.chat.completions.create(
+                messages=messages,
+                stream=False,
+                tools=format_rules,
+                tool_choice="auto",
+                **LLM_PARAMS
+            )
         response = completion.choices[0].message.tool_calls[0].function.arguments
         parsed_response = json.loads(response)
 
         with open(f'{Path("./sattern/src/data")}/{ticker}_{datetime.now().strftime("%Y%m%d")}_AI_RESPONSE.json', 'w') as f:
             json.dump(parsed_response, f, indent=4)
+        CACHE_PATH.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump(parsed_response, f, indent=4)
+        os.replace(tmp_file, cache_file)
         return parsed_response
     except OpenAIError as e:
         print(f"Error with LLM: {e}")
@@ -115,6 +158,19 @@ def run_llm(ticker: str, df: pd.DataFrame, actions: Dict[str, str], portfolio: p
         }
         return response
 
+def run_llm_batch(prompts: List[Tuple[str, pd.DataFrame, Dict, portfolio]], max_concurrency: int = 4) -> List[Dict]:
+    # run_llm for many (ticker, df, actions, portfolio) at once, at most max_concurrency requests in flight on one
+    # shared client. Cached prompts never reach the API, and the client is only created if some prompt is not
+    # cached. Results are in the order of prompts
+    results = [cached_response(*build_prompt(*prompt)) for prompt in prompts]
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        client = get_client()
+        with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            for i, result in zip(misses, pool.map(lambda i: run_llm(*prompts[i], client=client, use_cache=False), misses)):
+                results[i] = result
+    return results
+
 if __name__ == "__main__":
     messages = [{"role":"user","content":"Write a limerick about the wonders of GPU computing."}]
     run_llm(messages)
@@ -1,24 +1,47 @@
-from sattern.src import api, display, llm, trader, process
+from sattern.src import api, display, trader, process, profiler, stream, signal_cache
 from typing import Dict
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta, timezone
 
-def run_fund_manager(ticker: str, start_date: datetime, end_date: datetime):
+def run_fund_manager(ticker: str, start_date: datetime, end_date: datetime, interval: str = "daily"):
+    # interval "1min", "5min", ... runs on intraday bars between start_date and end_date
     period, max_diff = 10, 2
 
     portfolio = trader.portfolio(10000, 0)
-    prices = api.get_prices(ticker)
-    news = api.get_news(ticker, start_date, end_date)
-    insider_trades = api.get_insider_transactions(ticker)
+    with profiler.span("load.prices"):
+        prices = api.get_prices(ticker) if interval == "daily" else api.get_intraday_prices(ticker, interval, start_date, end_date)
+    with profiler.span("load.news"):
+        news = api.get_news(ticker, start_date, end_date)
+    with profiler.span("load.insider_transactions"):
+        insider_trades = api.get_insider_transactions(ticker)
     # financial_metrics = api.get_financial_metrics(ticker, start_date, end_date)
 
-    p_news = process.process_news(ticker, news)
-    p_insider_transactions = process.process_insider_transactions(insider_trades)
-    p_sattern, sattern_action = process.sattern(prices["prices"], period, max_diff)
-    display_obj = display.custom_plot(ticker, prices["prices"])
-    display_obj.highlight(p_sattern["highlight"], period, max_diff, "yellow")
-    display_obj.plot(p_sattern["sattern"], "sattern", "green")
-    display_obj.show()
+    with profiler.span("news"):
+        p_news = process.process_news(ticker, news)
+    with profiler.span("insider_transactions"):
+        p_insider_transactions = process.process_insider_transactions(insider_trades)
+    with profiler.span("sattern"):
+        # The distance profile is O(n log n), the greedy scan grows with period times the number of bars
+        mode = "greedy" if interval == "daily" else "fft"
+        values = prices["prices"].to_numpy(dtype=float)
+        key = signal_cache.window_keys(prices.index[:1].as_unit("ns").asi8, values, np.array([0]), np.array([len(values)]))[0]
+        # Nothing to plot, so the action an earlier run computed on the same bars is all that is needed. That run
+        # also brought the daily state up to these bars
+        sattern_action = signal_cache.lookup_action(ticker, mode, period, max_diff, key) if display.headless() else None
+        if sattern_action is None:
+            if interval == "daily":
+                # Only the bars that arrived since the last run are matched, the rest of the state is loaded from disk
+                p_sattern, sattern_action = stream.update_state(ticker, prices, period, max_diff).sattern()
+            else:
+                p_sattern, sattern_action = process.sattern(prices["prices"], period, max_diff, mode=mode)
+            signal_cache.save_action(ticker, mode, period, max_diff, key, sattern_action)
+    if not display.headless():
+        with profiler.span("plot"):
+            display_obj = display.custom_plot(ticker, prices["prices"])
+            display_obj.highlight(p_sattern["highlight"], period, max_diff, "yellow")
+            display_obj.plot(p_sattern["sattern"], "sattern", "green")
+        display_obj.show()
 
     actions = {
         "news": p_news,
@@ -26,13 +49,16 @@ def run_fund_manager(ticker: str, start_date: datetime, end_date: datetime):
         "sattern": sattern_action
     }
 
+    # from sattern.src import llm
     # p_llm = llm.run_llm(ticker, prices, actions, portfolio)
     # print(f"AI Decision: {p_llm['action']} {p_llm['quantity']}, prediction {p_llm['prediction']}")
 
     # Execute trade
     # portfolio.execute_trade(p_llm['action'], prices['prices'].iloc[0], p_llm['quantity'], True)
-    portfolio.execute_trade(actions, prices['prices'].iloc[0], show=True)
+    with profiler.span("trade"):
+        portfolio.execute_trade(actions, prices['prices'].iloc[0], show=True)
     print(portfolio)
+    profiler.report(f"fund_manager_{ticker}")
 
 def main():
     ticker = "ERJ"
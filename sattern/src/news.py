@@ -0,0 +1,108 @@
+"""Columnar index over a news sentiment feed"""
+import numpy as np
+import pandas as pd
+from datetime import timedelta, timezone
+from typing import Dict, List, Tuple
+from sattern.src import process
+
+class news_index():
+    # Parses a NEWS_SENTIMENT feed once into one row per (article, ticker) rating, sorted by publish time, so the
+    # sentiment of a ticker as of any date is two binary searches into cumulative sums
+    def __init__(self, news_data: Dict):
+        feed = [] if news_data is None else news_data["feed"]
+        article_times = pd.to_datetime([article["time_published"] for article in feed], format="%Y%m%dT%H%M%S", utc=True).as_unit("ns")
+
+        articles, tickers, relevance, sentiment, labels = [], [], [], [], []
+        for i, article in enumerate(feed):
+            for rating in article["ticker_sentiment"]:
+                articles.append(i)
+                tickers.append(rating["ticker"])
+                relevance.append(float(rating["relevance_score"]))
+                sentiment.append(float(rating["ticker_sentiment_score"]))
+                labels.append(rating["ticker_sentiment_label"])
+
+        # Oldest first. Articles published at the same time keep the reverse of their feed order, so reading the
+        # rows backwards gives the feed's own latest first order
+        articles = np.array(articles, dtype=np.int64)
+        order = np.lexsort((-articles, article_times.asi8[articles]))
+        self.feed: List[Dict] = feed
+        self.articles: np.ndarray = articles[order]
+        self.times: np.ndarray = article_times.asi8[self.articles]
+        self.tickers: np.ndarray = np.array(tickers, dtype=object)[order]
+        self.relevance: np.ndarray = np.array(relevance, dtype=float)[order]
+        self.sentiment: np.ndarray = np.array(sentiment, dtype=float)[order]
+        self.labels: np.ndarray = np.array(labels, dtype=object)[order]
+
+        self.ticker_names, self.ticker_codes = np.unique(self.tickers.astype(str), return_inverse=True)
+
+        # Rows of each ticker (still in time order) with cumulative relevance and relevance weighted sentiment
+        self._ticker_rows: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        for code, ticker in enumerate(self.ticker_names):
+            rows = np.flatnonzero(self.ticker_codes == code)
+            cum_relevance = np.concatenate(([0.0], np.cumsum(self.relevance[rows])))
+            cum_sentiment = np.concatenate(([0.0], np.cumsum(self.sentiment[rows] * self.relevance[rows])))
+            self._ticker_rows[ticker] = (rows, cum_relevance, cum_sentiment)
+
+    def weighted_sentiment(self, ticker: str, dates: pd.DatetimeIndex, window: timedelta = timedelta(days=30)) -> np.ndarray:
+        # Relevance weighted sentiment of articles published in [date - window, date) for each date
+        dates = pd.DatetimeIndex(dates)
+        if ticker not in self._ticker_rows:
+            return np.zeros(len(dates))
+        rows, cum_relevance, cum_sentiment = self._ticker_rows[ticker]
+        times = self.times[rows]
+        end = np.searchsorted(times, dates.as_unit("ns").asi8, side="left")
+        start = np.searchsorted(times, (dates - window).as_unit("ns").asi8, side="left")
+
+        total_relevance = cum_relevance[end] - cum_relevance[start]
+        total_sentiment = cum_sentiment[end] - cum_sentiment[start]
+        weighted = np.zeros(len(dates))
+        np.divide(total_sentiment, total_relevance, out=weighted, where=total_relevance != 0)
+        return weighted
+
+    def actions(self, ticker: str, dates: pd.DatetimeIndex, window: timedelta = timedelta(days=30)) -> List[str]:
+        # process_news action as of each date
+        return [process.news_signal(weighted) for weighted in self.weighted_sentiment(ticker, dates, window)]
+
+    def process_news(self, tickers: List[str], as_of: pd.Timestamp = None, window: timedelta = timedelta(days=30), top_n: int = 11) -> Dict[str, Dict]:
+        # process.process_news for many tickers in one pass. Uses articles from [as_of - window, as_of), as_of
+        # defaults to now. top_n is 11 to match process_news, which keeps up to 11 articles
+        if as_of is None:
+            end = len(self.times)
+            as_of = pd.Timestamp.now(tz=timezone.utc)
+        else:
+            as_of = pd.Timestamp(as_of)
+            end = np.searchsorted(self.times, as_of.value, side="left")
+        start = np.searchsorted(self.times, (as_of - window).value, side="left")
+
+        # Weighted sentiment of every ticker in the window at once
+        codes = self.ticker_codes[start:end]
+        total_relevance = np.bincount(codes, weights=self.relevance[start:end], minlength=len(self.ticker_names))
+        total_sentiment = np.bincount(codes, weights=self.sentiment[start:end] * self.relevance[start:end], minlength=len(self.ticker_names))
+        weighted = np.zeros(len(self.ticker_names))
+        np.divide(total_sentiment, total_relevance, out=weighted, where=total_relevance != 0)
+
+        # Latest top_n ratings of each requested ticker: group the window latest first by ticker and rank within groups
+        wanted = np.flatnonzero(np.isin(self.ticker_names, tickers))
+        latest = np.arange(end - 1, start - 1, -1)
+        latest = latest[np.isin(self.ticker_codes[latest], wanted)]
+        grouped = latest[np.argsort(self.ticker_codes[latest], kind="stable")]
+        grouped_codes = self.ticker_codes[grouped]
+        rank = np.arange(len(grouped)) - np.searchsorted(grouped_codes, grouped_codes, side="left")
+        top_rows = grouped[rank < top_n]
+
+        p_news: Dict[str, Dict] = {ticker: {"top_news": [], "action": "Hold"} for ticker in tickers}
+        for code in wanted:
+            p_news[self.ticker_names[code]]["action"] = process.news_signal(weighted[code])
+        for row in top_rows:
+            article = self.feed[self.articles[row]]
+            p_news[self.ticker_names[self.ticker_codes[row]]]["top_news"].append({
+                "title": article["title"],
+                "url": article["url"],
+                "summary": article["summary"],
+                "sentiment": self.labels[row]
+            })
+        return p_news
+
+def process_news_multi(tickers: List[str], news_data: Dict) -> Dict[str, Dict]:
+    # Columnar process.process_news for a watchlist sharing one news payload
+    return news_index(news_data).process_news(tickers)
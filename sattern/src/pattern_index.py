@@ -0,0 +1,220 @@
+"""Cross-ticker index of price patterns with approximate nearest neighbour search."""
+import os
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from sattern.src import api, process
+
+INDEX_PATH = Path("./sattern/src/data/patterns")
+
+class pattern_index():
+    # Every <period> day window of every indexed ticker, as the daily returns leading up to its last bar, with the
+    # <horizon> returns that followed it. Returns make windows of differently priced tickers comparable.
+    # Search is locality sensitive hashing (E2LSH): each of `tables` hash tables buckets a window by `bits` random
+    # projections quantized to `width`, close windows share a bucket in at least one table with high probability.
+    # A query only computes exact distances for the windows in its own (and neighbouring) buckets.
+    # Each table is kept as sorted bucket keys with the matching rows, so a bucket lookup is a binary search and new
+    # windows are merged in without rehashing the index
+    def __init__(self, period: int = 10, horizon: int = None, tables: int = 8, bits: int = 6, width: float = 0.05, seed: int = 0):
+        self.period = period
+        self.horizon = horizon or period
+        self.tables = tables
+        self.bits = bits
+        self.width = width
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.projections: np.ndarray = rng.standard_normal((period, tables * bits))
+        self.offsets: np.ndarray = rng.uniform(0, width, tables * bits)
+        # Folds the bits quantized projections of a table into one int64 bucket key (wrapping multiply and add)
+        self.multipliers: np.ndarray = rng.integers(1, np.iinfo(np.int64).max, bits, dtype=np.int64) | 1
+
+        self.windows = np.zeros((0, period), dtype=np.float32)
+        self.following = np.zeros((0, self.horizon), dtype=np.float32)
+        self.ticker_codes = np.zeros(0, dtype=np.int32)
+        self.dates = np.zeros(0, dtype=np.int64)
+        self.ticker_names: List[str] = []
+        # Date (int64 ns) of the last window indexed for each ticker
+        self.last_dates: Dict[str, int] = {}
+        self.keys = np.zeros((tables, 0), dtype=np.int64)
+        self.rows = np.zeros((tables, 0), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    def hash(self, windows: np.ndarray) -> np.ndarray:
+        # Quantized projections, shape (windows, tables, bits)
+        projected = (np.asarray(windows, dtype=float) @ self.projections + self.offsets) / self.width
+        return np.floor(projected).astype(np.int64).reshape(len(windows), self.tables, self.bits)
+
+    def bucket_keys(self, hashes: np.ndarray) -> np.ndarray:
+        # One key per window and table, shape (tables, windows)
+        with np.errstate(over="ignore"):
+            return (hashes * self.multipliers).sum(axis=2).T
+
+    def add(self, ticker: str, prices: pd.DataFrame) -> int:
+        # Index the windows of ticker that end after the last one already indexed and have <horizon> bars after
+        # them. prices is laid out like api.get_prices (newest first). Returns the number of windows added
+        return self.add_many({ticker: prices})[ticker]
+
+    def add_many(self, prices: Dict[str, pd.DataFrame]) -> Dict[str, int]:
+        # add for many tickers, merging all their windows into the hash tables at once
+        added: Dict[str, int] = {}
+        new_windows, new_following, new_codes, new_dates = [], [], [], []
+        for ticker, df in prices.items():
+            values = df["prices"].to_numpy(dtype=float)[::-1]
+            dates = df.index[::-1].as_unit("ns").asi8
+            returns = values[1:] / values[:-1] - 1
+
+            # A window ending at bar e holds returns[e - period:e], its following returns are returns[e:e + horizon]
+            first = max(self.period, int(np.searchsorted(dates, self.last_dates.get(ticker, np.iinfo(np.int64).min), side="right")))
+            ends = np.arange(first, len(values) - self.horizon)
+            windows = returns[ends[:, None] + np.arange(-self.period, 0)]
+            following = returns[ends[:, None] + np.arange(self.horizon)]
+            valid = np.isfinite(windows).all(axis=1) & np.isfinite(following).all(axis=1)
+            ends = ends[valid]
+            added[ticker] = len(ends)
+            if len(ends) == 0:
+                continue
+
+            if ticker not in self.ticker_names:
+                self.ticker_names.append(ticker)
+            new_windows.append(windows[valid].astype(np.float32))
+            new_following.append(following[valid].astype(np.float32))
+            new_codes.append(np.full(len(ends), self.ticker_names.index(ticker), dtype=np.int32))
+            new_dates.append(dates[ends])
+            self.last_dates[ticker] = int(dates[ends[-1]])
+
+        if new_windows:
+            first_row = len(self.windows)
+            self.windows = np.concatenate((self.windows, *new_windows))
+            self.following = np.concatenate((self.following, *new_following))
+            self.ticker_codes = np.concatenate((self.ticker_codes, *new_codes))
+            self.dates = np.concatenate((self.dates, *new_dates))
+            self._insert(np.arange(first_row, len(self.windows)), self.windows[first_row:])
+        return added
+
+    def _insert(self, rows: np.ndarray, windows: np.ndarray):
+        # Merge new rows into the sorted keys of every table
+        new_keys = self.bucket_keys(self.hash(windows))
+        keys, table_rows = [], []
+        for table in range(self.tables):
+            order = np.argsort(new_keys[table], kind="stable")
+            sorted_keys, sorted_rows = new_keys[table][order], rows[order]
+            positions = np.searchsorted(self.keys[table], sorted_keys, side="right")
+            keys.append(np.insert(self.keys[table], positions, sorted_keys))
+            table_rows.append(np.insert(self.rows[table], positions, sorted_rows))
+        self.keys, self.rows = np.array(keys, dtype=np.int64).reshape(self.tables, -1), np.array(table_rows, dtype=np.int64).reshape(self.tables, -1)
+
+    def latest_window(self, prices: pd.DataFrame) -> np.ndarray:
+        # Returns of the most recent <period> days of prices (newest first), oldest first
+        values = prices["prices"].to_numpy(dtype=float)[:self.period + 1][::-1]
+        return values[1:] / values[:-1] - 1
+
+    def candidates(self, window: np.ndarray, probe: bool = True) -> np.ndarray:
+        # Rows sharing a bucket with window in any table. probe also looks in the buckets one quantization step
+        # away along each projection, which finds most near misses for a few more binary searches per table
+        hashes = self.hash(window[None, :])
+        if probe:
+            steps = np.concatenate((np.eye(self.bits, dtype=np.int64), -np.eye(self.bits, dtype=np.int64)))
+            hashes = np.concatenate((hashes, hashes + steps[:, None, :]))
+        keys = self.bucket_keys(hashes)
+        found = []
+        for table in range(self.tables):
+            lo = np.searchsorted(self.keys[table], keys[table], side="left")
+            hi = np.searchsorted(self.keys[table], keys[table], side="right")
+            found += [self.rows[table][start:end] for start, end in zip(lo, hi)]
+        return np.unique(np.concatenate(found))
+
+    def query(self, prices: pd.DataFrame, k: int = 10, exclude: str = None, max_distance: float = None) -> List[Tuple[int, float]]:
+        # (row, distance) of the k windows closest to the latest <period> days of prices, closest first. Like
+        # select_similar_periods, a window within half a period of a closer match of the same ticker is dropped.
+        # exclude leaves out a ticker, typically the one being queried
+        window = self.latest_window(prices)
+        rows = self.candidates(window)
+        if exclude is not None and exclude in self.ticker_names:
+            rows = rows[self.ticker_codes[rows] != self.ticker_names.index(exclude)]
+        distances = np.sqrt(((self.windows[rows] - window) ** 2).sum(axis=1))
+        if max_distance is not None:
+            rows, distances = rows[distances <= max_distance], distances[distances <= max_distance]
+
+        matches: List[Tuple[int, float]] = []
+        skip = max(self.period // 2, 1)
+        codes = self.ticker_codes[rows]
+        days = np.asarray(self.dates[rows]).view("datetime64[ns]").astype("datetime64[D]")
+        kept: List[int] = []
+        for i in np.argsort(distances, kind="stable"):
+            if any(codes[i] == codes[j] and abs(np.busday_count(days[j], days[i])) < skip for j in kept):
+                continue
+            kept.append(i)
+            matches.append((int(rows[i]), float(distances[i])))
+            if len(matches) == k:
+                break
+        return matches
+
+    def describe(self, matches: List[Tuple[int, float]]) -> List[Tuple[str, pd.Timestamp, float]]:
+        # (ticker, last day of the window, distance) of each match
+        return [(self.ticker_names[self.ticker_codes[row]], pd.Timestamp(int(self.dates[row]), tz="UTC"), distance) for row, distance in matches]
+
+    def forecast(self, prices: pd.DataFrame, matches: List[Tuple[int, float]]) -> np.ndarray:
+        # Predicted price for today and the next <horizon> days, from the returns that followed each match weighted
+        # by its distance (process.distance_forecast). The hash width is the scale of a near miss
+        rows = np.array([row for row, _ in matches])
+        distances = np.array([distance for _, distance in matches])
+        following_returns = process.distance_forecast(distances, self.following[rows].astype(float), self.width)
+        current_price = float(prices["prices"].iloc[0])
+        return np.concatenate(([current_price], current_price + np.cumsum(current_price * following_returns)))
+
+    def action(self, prices: pd.DataFrame, k: int = 10, exclude: str = None, max_distance: float = 0.1) -> Dict:
+        # Same result as process.sattern_multi gives for one period, with analogues from every indexed ticker
+        matches = self.query(prices, k, exclude, max_distance)
+        if len(matches) == 0:
+            return {"action": "Hold"}
+        prediction = self.forecast(prices, matches)
+        return process.sattern_action(prices["prices"].to_numpy(dtype=float), self.describe(matches), prediction)
+
+    def save(self, path: Path = None):
+        path = Path(path or INDEX_PATH / f"period_{self.period}")
+        path.mkdir(parents=True, exist_ok=True)
+        arrays = {"windows": self.windows, "following": self.following, "ticker_codes": self.ticker_codes, "dates": self.dates, "keys": self.keys, "rows": self.rows}
+        for name, values in arrays.items():
+            tmp_path = path / f"{name}.npy.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, values)
+            os.replace(tmp_path, path / f"{name}.npy")
+        # Written last, so an interrupted save leaves arrays that disagree with meta and is detected on load
+        meta = {
+            "period": self.period, "horizon": self.horizon, "tables": self.tables, "bits": self.bits, "width": self.width, "seed": self.seed,
+            "ticker_names": self.ticker_names, "last_dates": self.last_dates, "size": len(self.windows),
+        }
+        tmp_path = path / "meta.json.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=4)
+        os.replace(tmp_path, path / "meta.json")
+
+    @classmethod
+    def load(cls, period: int = 10, path: Path = None) -> Optional["pattern_index"]:
+        # Saved index of period, or None if there is none or it was not saved completely
+        path = Path(path or INDEX_PATH / f"period_{period}")
+        if not (path / "meta.json").exists():
+            return None
+        with open(path / "meta.json", 'r') as f:
+            meta = json.load(f)
+        index = cls(meta["period"], meta["horizon"], meta["tables"], meta["bits"], meta["width"], meta["seed"])
+        # Windows are memory mapped, a query only touches the rows of its candidates
+        for name in ["windows", "following", "ticker_codes", "dates", "keys", "rows"]:
+            setattr(index, name, np.load(path / f"{name}.npy", mmap_mode="r" if name in ("windows", "following") else None))
+        if len(index.windows) != meta["size"] or index.keys.shape != (index.tables, meta["size"]):
+            return None
+        index.ticker_names = meta["ticker_names"]
+        index.last_dates = meta["last_dates"]
+        return index
+
+def update_index(tickers: List[str], period: int = 10, path: Path = None) -> pattern_index:
+    # Add the latest bars of every ticker to the saved index of period (creating it if needed) and save it
+    index = pattern_index.load(period, path) or pattern_index(period)
+    index.add_many({ticker: api.get_prices(ticker) for ticker in tickers})
+    index.save(path)
+    return index
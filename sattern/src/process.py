@@ -1,8 +1,13 @@
 """Process various metrics"""
+import numpy as np
 import pandas as pd
-from typing import Dict, Tuple, List
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Dict, Tuple, List, Union, Optional
 from datetime import timedelta, timezone
 
+# Windows compared at once by the greedy scan, bounds its memory to about CHUNK_SIZE * period * 8 bytes per array
+CHUNK_SIZE = 1 << 16
+
 def process_news(ticker: str, news_data: Dict) -> Dict:
     if news_data is None:
         return {
@@ -36,29 +41,34 @@ def process_news(ticker: str, news_data: Dict) -> Dict:
     else:
         weighted_sentiment = total_sentiment / total_relevance
 
+    p_news = {
+        "top_news": top_news,
+        "action": news_signal(weighted_sentiment)
+    }
+    return p_news
+
+def news_signal(weighted_sentiment: float) -> str:
     if weighted_sentiment <= -0.35:
-        action = "Strong Sell"
+        return "Strong Sell"
     elif weighted_sentiment <= -0.15:
-        action = "Sell"
+        return "Sell"
     elif weighted_sentiment < 0.15:
-        action = "Hold"
+        return "Hold"
     elif weighted_sentiment < 0.35:
-        action = "Buy"
+        return "Buy"
     else:
-        action = "Strong Buy"
+        return "Strong Buy"
 
-    p_news = {
-        "top_news": top_news,
-        "action": action
-    }
-    return p_news
+def news_signals(weighted_sentiment: np.ndarray) -> np.ndarray:
+    # news_signal of many sentiments at once
+    weighted_sentiment = np.asarray(weighted_sentiment, dtype=float)
+    return np.select(
+        [weighted_sentiment <= -0.35, weighted_sentiment <= -0.15, weighted_sentiment < 0.15, weighted_sentiment < 0.35],
+        ["Strong Sell", "Sell", "Hold", "Buy"],
+        "Strong Buy"
+    )
 
 def process_insider_transactions(df: pd.DataFrame) -> Dict:
-    a_count = 0
-    d_count = 0
-    total_money_moved = 0
-    total_shares_moved = 0
-
     # Ensure columns exist
     required_cols = ["acquisition_or_disposal", "shares", "share_price"]
     if df is None or not all(col in df.columns for col in required_cols):
@@ -68,125 +78,303 @@ def process_insider_transactions(df: pd.DataFrame) -> Dict:
     df["shares"] = pd.to_numeric(df["shares"], errors="coerce")
     df["share_price"] = pd.to_numeric(df["share_price"], errors="coerce")
 
-    for _, row in df.iterrows():
-        if pd.notnull(row["acquisition_or_disposal"]):
-            shares = row["shares"]
-            share_price = row["share_price"]
-            money_moved = shares * share_price
-
-            if row["acquisition_or_disposal"] == "A":
-                a_count += 1
-                total_shares_moved += shares
-                total_money_moved += money_moved
-            elif row["acquisition_or_disposal"] == "D":
-                d_count += 1
-                total_shares_moved -= shares
-                total_money_moved -= money_moved
+    signed_shares, signed_money = insider_flows(df)
+    p_insider_transactions = {
+        "action": insider_signal(signed_shares.sum(), signed_money.sum()),
+    }
+    return p_insider_transactions
+
+def insider_flows(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    # Shares and money moved by each transaction, positive for acquisitions and negative for disposals.
+    # Transactions that are neither count as zero
+    direction = np.select([df["acquisition_or_disposal"] == "A", df["acquisition_or_disposal"] == "D"], [1.0, -1.0], 0.0)
+    shares = df["shares"].to_numpy(dtype=float)
+    money = shares * df["share_price"].to_numpy(dtype=float)
+    return np.where(direction != 0, direction * shares, 0.0), np.where(direction != 0, direction * money, 0.0)
 
+def insider_signal(total_shares_moved: float, total_money_moved: float) -> str:
     if total_shares_moved < -1000 and total_money_moved < -100000:
-        action = "Strong Sell"
+        return "Strong Sell"
     elif total_shares_moved < -500:
-        action = "Sell"
+        return "Sell"
     elif -500 <= total_shares_moved <= 500:
-        action = "Hold"
+        return "Hold"
     elif total_shares_moved > 1000 and total_money_moved > 100000:
-        action = "Strong Buy"
+        return "Strong Buy"
     else:
-        action = "Buy"
+        return "Buy"
 
-    p_insider_transactions = {
-        "action": action,
+def insider_signals(total_shares_moved: np.ndarray, total_money_moved: np.ndarray) -> np.ndarray:
+    # insider_signal of many flows at once
+    shares, money = np.asarray(total_shares_moved, dtype=float), np.asarray(total_money_moved, dtype=float)
+    return np.select(
+        [(shares < -1000) & (money < -100000), shares < -500, (-500 <= shares) & (shares <= 500), (shares > 1000) & (money > 100000)],
+        ["Strong Sell", "Sell", "Hold", "Strong Buy"],
+        "Buy"
+    )
+
+def price_diffs(prices: np.ndarray) -> np.ndarray:
+    # Day over day price change, newest first. diffs[i] is the move from day i+1 to day i
+    return prices[:-1] - prices[1:]
+
+def find_similar_periods(diffs: np.ndarray, period: int, max_diff: float, chunk_size: int = CHUNK_SIZE) -> List[Tuple[int, float]]:
+    # Every start index that has a full comparison window, oldest first to match the greedy scan
+    starts = np.arange(len(diffs) - 1, 2 * period - 1, -1)
+    if len(starts) == 0:
+        return []
+
+    # Compare the most recent <period> diffs to every window, stepping back in time from each start. Windows are
+    # compared chunk_size at a time so memory stays bounded on intraday histories of millions of bars
+    curr_period_diff = diffs[1:period + 1][::-1]
+    all_windows = sliding_window_view(diffs, period)
+    matches = np.empty(len(starts), dtype=bool)
+    cum_diffs = np.empty(len(starts))
+    for first in range(0, len(starts), chunk_size):
+        chunk = slice(first, first + chunk_size)
+        comp_diff = curr_period_diff - all_windows[starts[chunk] - period, ::-1]
+        comp_cum_diff = np.cumsum(comp_diff, axis=1)
+        matches[chunk] = (np.abs(comp_diff) <= max_diff).all(axis=1) & (np.abs(comp_cum_diff) <= max_diff).all(axis=1)
+        cum_diffs[chunk] = comp_cum_diff[:, -1]
+
+    return select_similar_periods(starts, matches, cum_diffs, period)
+
+def select_similar_periods(starts: np.ndarray, matches: np.ndarray, cum_diffs: np.ndarray, period: int) -> List[Tuple[int, float]]:
+    # After a match the scan skips ahead half a period, so overlapping matches are dropped. starts run oldest first
+    similar_periods: List[Tuple[int, float]] = []
+    skip = max(period // 2, 1)
+    next_start = np.inf
+    for i in np.flatnonzero(matches):
+        start = int(starts[i])
+        if start <= next_start:
+            similar_periods.append((start, float(cum_diffs[i])))
+            next_start = start - skip
+    return similar_periods
+
+def find_similar_periods_multi(diffs: np.ndarray, periods: List[int], max_diff: float, chunk_size: int = CHUNK_SIZE) -> Dict[int, List[Tuple[int, float]]]:
+    similar_periods: Dict[int, List[Tuple[int, float]]] = {period: [] for period in periods}
+    valid_periods = [period for period in periods if 2 * period <= len(diffs) - 1]
+    if len(valid_periods) == 0:
+        return similar_periods
+    min_period, max_period = min(valid_periods), max(valid_periods)
+
+    # Element j of the most recent period is compared to element j + lag of an older window. For a fixed lag that
+    # comparison is the same for every period, a shorter period just uses fewer elements of it.
+    # Lags are compared chunk_size at a time like find_similar_periods, only the per period results span all lags
+    lags = np.arange(len(diffs) - 2 - min_period, min_period - 2, -1)
+    j = np.arange(1, max_period + 1)
+    padded = np.concatenate((diffs, np.full(max_period + 1, np.inf)))
+    matches = {period: np.zeros(len(lags), dtype=bool) for period in valid_periods}
+    cum_diffs = {period: np.zeros(len(lags)) for period in valid_periods}
+    for first in range(0, len(lags), chunk_size):
+        chunk = slice(first, first + chunk_size)
+        comp_diff = diffs[j] - padded[lags[chunk, None] + j]
+
+        # First element over max_diff, plus prefix sums and their running extremes so the cumulative difference of
+        # any period (summed from element <period> back to 1) can be bounded without rescanning
+        over = np.abs(comp_diff) > max_diff
+        first_over = np.where(over.any(axis=1), over.argmax(axis=1) + 1, max_period + 1)
+        prefix = np.concatenate((np.zeros((len(comp_diff), 1)), np.cumsum(comp_diff, axis=1)), axis=1)
+        prefix_max = np.maximum.accumulate(prefix, axis=1)
+        prefix_min = np.minimum.accumulate(prefix, axis=1)
+
+        # Lags past the end of the history compare against the inf padding, they are outside every period's rows
+        with np.errstate(invalid="ignore"):
+            for period in valid_periods:
+                cum_diff = prefix[:, period]
+                max_comp_diff = np.maximum(prefix_max[:, period - 1] - cum_diff, cum_diff - prefix_min[:, period - 1])
+                matches[period][chunk] = (first_over > period) & (max_comp_diff <= max_diff)
+                cum_diffs[period][chunk] = cum_diff
+
+    for period in valid_periods:
+        rows = slice(period - min_period, len(lags) - (period - min_period))
+        starts = lags[rows] + 1 + period
+        similar_periods[period] = select_similar_periods(starts, matches[period][rows], cum_diffs[period][rows], period)
+    return similar_periods
+
+def distance_profile(diffs: np.ndarray, period: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Euclidean distance between the most recent <period> diffs and the window of every start find_similar_periods
+    # considers, plus the cumulative difference it would report for that start. MASS style: the sliding dot products
+    # with the template come from one FFT convolution, the window norms from prefix sums, so the cost is
+    # O(n log n) whatever the period. Starts run oldest first
+    n = len(diffs)
+    starts = np.arange(n - 1, 2 * period - 1, -1)
+    if len(starts) == 0:
+        return starts, np.zeros(0), np.zeros(0)
+
+    # The window of start s is diffs[s - period:s], lined up element by element with the template diffs[1:period + 1]
+    template = diffs[1:period + 1]
+    size = 1 << int(np.ceil(np.log2(n + period)))
+    dots = np.fft.irfft(np.fft.rfft(diffs, size) * np.fft.rfft(template[::-1], size), size)[period - 1:n]
+    prefix = np.concatenate(([0.0], np.cumsum(diffs)))
+    prefix_sq = np.concatenate(([0.0], np.cumsum(diffs**2)))
+
+    firsts = starts - period
+    window_sums = prefix[firsts + period] - prefix[firsts]
+    window_sq = prefix_sq[firsts + period] - prefix_sq[firsts]
+    squared = (template**2).sum() + window_sq - 2 * dots[firsts]
+    distances = np.sqrt(np.maximum(squared, 0))
+    cum_diffs = template.sum() - window_sums
+    return starts, distances, cum_diffs
+
+def find_similar_periods_fft(diffs: np.ndarray, period: int, k: int = 10, max_distance: Optional[float] = None) -> List[Tuple[int, float]]:
+    # The k closest windows by distance_profile that do not overlap each other, optionally only those within
+    # max_distance. Unlike the greedy scan a close match is never skipped because an earlier one was taken.
+    # Returns (start, cumulative difference) oldest first, like find_similar_periods
+    starts, distances, cum_diffs = distance_profile(diffs, period)
+    taken = np.zeros(len(starts), dtype=bool)
+    selected: List[int] = []
+    # Each pick rules out fewer than 2 * period neighbours, so the k picks are among the k * 2 * period closest
+    # windows. Only those are sorted, which matters on intraday histories of millions of windows
+    closest = k * 2 * period
+    if closest < len(distances):
+        order = np.argpartition(distances, closest)[:closest]
+        order = order[np.lexsort((order, distances[order]))]
+    else:
+        order = np.argsort(distances, kind="stable")
+    for i in order:
+        if len(selected) == k or (max_distance is not None and distances[i] > max_distance):
+            break
+        if taken[i]:
+            continue
+        selected.append(i)
+        # starts are consecutive, so every window overlapping this one is within period positions of it
+        taken[max(i - period + 1, 0):i + period] = True
+    selected.sort()
+    return [(int(starts[i]), float(cum_diffs[i])) for i in selected]
+
+def similar_periods_by_mode(diffs: np.ndarray, period: int, max_diff: float, mode: str = "greedy", k: int = 10, max_distance: Optional[float] = None) -> List[Tuple[int, float]]:
+    # mode "greedy" is the element by element scan of find_similar_periods, "fft" the top-k distance profile matches
+    if mode == "greedy":
+        return find_similar_periods(diffs, period, max_diff)
+    elif mode == "fft":
+        return find_similar_periods_fft(diffs, period, k, max_distance)
+    raise ValueError(f"Unknown sattern mode {mode}, expected greedy or fft")
+
+def sattern_forecast(diffs: np.ndarray, similar_periods: List[Tuple[int, float]], period: int, max_diff: float, mode: str = "greedy") -> np.ndarray:
+    # Price movement following each similar period, weighted by how similar it is to the most recent <period> days.
+    # fft matches are not bounded by max_diff, so max_diff - cum_diff could go negative and they are weighted by
+    # their distance instead, with max_diff as the scale
+    starts = np.array([start for start, _ in similar_periods])
+    sim_diffs = np.array([diff for _, diff in similar_periods])
+    following_diffs = diffs[starts[:, None] - np.arange(period)]
+    if mode == "fft":
+        return distance_forecast(match_distances(diffs, starts, period), following_diffs, max_diff)
+    return weighted_forecast(sim_diffs, following_diffs, max_diff)
+
+def match_distances(diffs: np.ndarray, starts: np.ndarray, period: int) -> np.ndarray:
+    # distance_profile of just the given starts
+    windows = diffs[starts[:, None] - period + np.arange(period)]
+    return np.sqrt(((windows - diffs[1:period + 1]) ** 2).sum(axis=1))
+
+def weighted_forecast(sim_diffs: np.ndarray, following_diffs: np.ndarray, max_diff: float) -> np.ndarray:
+    # Rows of following_diffs (the moves after each match, oldest first) weighted by max_diff - the difference of
+    # the match. Also used for matches from other tickers (see pattern_index)
+    period_difference = (max_diff - sim_diffs) @ following_diffs
+
+    # Normalize
+    total_difference = np.abs(sim_diffs).sum()
+    return period_difference / total_difference
+
+def distance_forecast(distances: np.ndarray, following_diffs: np.ndarray, scale: float) -> np.ndarray:
+    # Rows of following_diffs weighted by distance_weights, for matches ranked by an unsigned distance instead of a
+    # cum_diff within max_diff
+    return distance_weights(distances, scale) @ following_diffs
+
+def distance_weights(distances: np.ndarray, scale: float) -> np.ndarray:
+    # 1 / (1 + distance / scale) of each match, summing to 1. Weights are positive and an exact match (distance 0)
+    # gets the largest, scale is the distance at which a match counts half as much as an exact one
+    weights = 1 / (1 + np.asarray(distances, dtype=float) / scale)
+    return weights / weights.sum()
+
+def sattern_prediction(prices: np.ndarray, diffs: np.ndarray, similar_periods: List[Tuple[int, float]], period: int, max_diff: float, mode: str = "greedy") -> np.ndarray:
+    # Predicted price for today and each of the next <period> days
+    sim_period_difference = sattern_forecast(diffs, similar_periods, period, max_diff, mode)
+    return np.concatenate(([prices[0]], prices[0] + np.cumsum(sim_period_difference)))
+
+def sattern_action(prices: np.ndarray, similar_periods: List[Tuple[int, float]], prediction: np.ndarray) -> Dict:
+    percent_change = (prediction[-1] - prices[0]) / prices[0]
+    return {
+        "sim_periods": similar_periods,
+        "price_prediction": prediction[-1],
+        "action": sattern_signal(percent_change)
     }
-    return p_insider_transactions
 
-def sattern(df:pd.DataFrame, period:int=10, max_diff:int=2) -> Tuple[pd.DataFrame, Dict]:
-    # For each element in the current period, find the difference to the previous element
-    curr_period_diff: List[float] = []
-    for i in range(period, -1, -1):
-        # print(f"Start: {df.index[i+1]} End: {df.index[i]}")
-        # print(f"Start Price: {df.iloc[i+1]} End Price: {df.iloc[i]}")
-        # print(f"Diff: {df.iloc[i] - df.iloc[i+1]}")
-        curr_period_diff.append(float(df.iloc[i] - df.iloc[i+1]))
-
-    curr_comp_start:int = len(df) - 2
-    curr_comp_length:int = 0
-    curr_comp_diff:float = 0.0
-    similar_periods: List[Tuple[int, float]] = []   # Store start index and difference of each period
-    index:int = len(df) - 2
-
-    while(index > period):
-        curr_diff:float = curr_period_diff[curr_comp_length] - float(df.iloc[curr_comp_start - curr_comp_length - 1] - df.iloc[curr_comp_start - curr_comp_length])
-        curr_comp_diff += curr_diff
-
-        curr_comp_length += 1
-        index -= 1
-
-        if abs(curr_diff) > max_diff or abs(curr_comp_diff) > max_diff:
-            curr_comp_start -= 1
-            index = curr_comp_start
-            curr_comp_length = 0
-            curr_comp_diff = 0.0
-        elif curr_comp_length >= period:
-            similar_periods.append( (curr_comp_start, curr_comp_diff) )
-            index = curr_comp_start - period // 2
-            curr_comp_start = index
-            curr_comp_length = 0
-            curr_comp_diff = 0
+def sattern(df:pd.DataFrame, period:int=10, max_diff:int=2, mode:str="greedy", k:int=10, max_distance:float=None) -> Tuple[pd.DataFrame, Dict]:
+    # mode "fft" matches the k closest non-overlapping windows instead (see find_similar_periods_fft)
+    prices = df.to_numpy(dtype=float)
+    diffs = price_diffs(prices)
+    similar_periods = similar_periods_by_mode(diffs, period, max_diff, mode, k, max_distance)
+    return sattern_result(df.index, prices, diffs, similar_periods, period, max_diff, mode)
 
+def sattern_result(dates: pd.DatetimeIndex, prices: np.ndarray, diffs: np.ndarray, similar_periods: List[Tuple[int, float]], period: int, max_diff: float, mode: str = "greedy") -> Tuple[pd.DataFrame, Dict]:
+    # The highlight/prediction DataFrame and action of sattern for similar periods that were already found.
+    # dates, prices and diffs are newest first
     if len(similar_periods) == 0:
         print("No similar patterns found")
         return pd.DataFrame(columns=["sattern", "highlight"]), {"action": "Hold"}
     else:
         # Combine similar periods into a DataFrame of start of period + difference to the most recent <period> days
         diff_data = [diff for _, diff in similar_periods]
-        index = [df.index[start] for start, _ in similar_periods]
+        index = [dates[start] for start, _ in similar_periods]
         highlight_df = pd.DataFrame(data=diff_data, index=index, columns=["highlight"])
         highlight_df.sort_index(inplace=True)
 
     # Use similar periods to predict the next stock price
-    period_difference: List[float] = []
-    for i in range(period):
-        period_difference.append(0.0)
-        for x in range(len(similar_periods)):
-            index = similar_periods[x][0] - i
-            # Weight by how similar the period is to the to the most recent <period> days
-            period_difference[i] += (df.iloc[index] - df.iloc[index + 1]) * (max_diff - similar_periods[x][1])
+    sim_period_price_prediction = sattern_prediction(prices, diffs, similar_periods, period, max_diff, mode)
+    step = bar_step(dates)
+    if step < timedelta(days=1):
+        # Intraday bars: the prediction steps forward one bar at a time
+        sim_period_dates = pd.date_range(start=dates[0], periods=period + 1, freq=step)
+    else:
+        sim_period_dates = pd.date_range(start=dates[0], end=dates[0] + timedelta(days=2*period), tz=timezone.utc, freq='B')
+        sim_period_dates = sim_period_dates[0:period+1]
 
-    # Normalize
-    total_difference = sum([abs(similar_periods[i][1]) for i in range(len(similar_periods))])
-    sim_period_difference = [price/total_difference for price in period_difference]
+    prediction_df = pd.DataFrame(
+        {"sattern": sim_period_price_prediction},
+        index=sim_period_dates
+    )
+    combined_df = pd.concat([highlight_df, prediction_df], axis=1)
 
-    # Calculate price movements and dates
-    sim_period_price_prediction: List[float] = []
-    sim_period_dates = pd.date_range(start=df.index[0], end=df.index[0] + timedelta(days=2*period), tz=timezone.utc, freq='B')
-    sim_period_dates = sim_period_dates[0:period+1]
+    return (combined_df, sattern_action(prices, similar_periods, sim_period_price_prediction))
 
-    sim_period_price_prediction.append(df.iloc[0])
-    for i in range(len(sim_period_difference)):
-        sim_period_price_prediction.append(sim_period_price_prediction[i] + sim_period_difference[i])
+def bar_step(dates: pd.DatetimeIndex, bars: int = 1000) -> pd.Timedelta:
+    # Spacing of the bars of dates (newest first): the median gap over the latest bars, so the overnight and weekend
+    # gaps before a session's first bar do not count. One day when there are fewer than two bars
+    recent = pd.DatetimeIndex(dates[:bars]).as_unit("ns").asi8
+    if len(recent) < 2:
+        return pd.Timedelta(days=1)
+    return pd.Timedelta(int(np.median(recent[:-1] - recent[1:])))
 
-    percent_change = (sim_period_price_prediction[-1] - df.iloc[0]) / df.iloc[0]
-    sattern_action = {
-        "sim_periods": similar_periods,
-        "price_prediction": sim_period_price_prediction[-1]
-    }
+def sattern_multi(prices: Union[pd.Series, np.ndarray], periods: List[int], max_diff: float = 2, diffs: Optional[np.ndarray] = None, mode: str = "greedy", k: int = 10, max_distance: Optional[float] = None) -> Dict[int, Dict]:
+    # Same signal as sattern for several window lengths, sharing the diffs and prefix sums between them.
+    # Skips building the highlight/prediction DataFrames, returns the sattern action for each period.
+    # diffs can be passed in when they are a view into diffs computed once for a longer history
+    prices = np.asarray(prices, dtype=float)
+    if diffs is None:
+        diffs = price_diffs(prices)
+    if mode == "greedy":
+        similar = find_similar_periods_multi(diffs, periods, max_diff)
+    else:
+        similar = {period: similar_periods_by_mode(diffs, period, max_diff, mode, k, max_distance) for period in periods}
+    actions: Dict[int, Dict] = {}
+    for period, similar_periods in similar.items():
+        if len(similar_periods) == 0:
+            actions[period] = {"action": "Hold"}
+            continue
+        prediction = sattern_prediction(prices, diffs, similar_periods, period, max_diff, mode)
+        actions[period] = sattern_action(prices, similar_periods, prediction)
+    return actions
+
+def sattern_signal(percent_change: float) -> str:
     if abs(percent_change) < 0.02:
-        sattern_action["action"] = "Hold"
+        return "Hold"
     elif percent_change > 0.02:
         if percent_change > 0.10:
-            sattern_action["action"] = "Strong Buy"
+            return "Strong Buy"
         else:
-            sattern_action["action"] = "Buy"
+            return "Buy"
     elif percent_change < 0.02:
         if percent_change < 0.10:
-            sattern_action["action"] = "Strong Sell"
+            return "Strong Sell"
         else:
-            sattern_action["action"] = "Sell"
-
-    prediction_df = pd.DataFrame(
-        {"sattern": sim_period_price_prediction},
-        index=sim_period_dates
-    )
-    combined_df = pd.concat([highlight_df, prediction_df], axis=1)
-
-    return (combined_df, sattern_action)
+            return "Sell"
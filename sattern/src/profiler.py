@@ -0,0 +1,170 @@
+"""Named timing spans, counters and optional peak memory per stage of a run."""
+import os
+import csv
+import json
+import time
+import threading
+import tracemalloc
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# SATTERN_PROFILE=json (or 1) or csv turns recording on and picks the report format, SATTERN_PROFILE_MEMORY=1 also
+# records the tracemalloc peak of every span. Off by default, a disabled span is a shared object that does nothing
+PROFILE_PATH = Path("./sattern/src/data/profiles")
+FIELDS = ["name", "calls", "total_s", "mean_s", "min_s", "max_s", "peak_bytes", "count"]
+
+_enabled: bool = os.getenv("SATTERN_PROFILE", "") not in ("", "0")
+_memory: bool = os.getenv("SATTERN_PROFILE_MEMORY", "") not in ("", "0")
+_format: str = "csv" if os.getenv("SATTERN_PROFILE", "").lower() == "csv" else "json"
+_stats: Dict[str, Dict] = {}
+_lock = threading.Lock()
+# Open memory spans of the current thread, innermost last
+_local = threading.local()
+
+class _null_span():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _null_span()
+
+class _span():
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        if _memory:
+            # tracemalloc has a single peak, so it is reset for every span and the peak seen so far is handed to
+            # the enclosing span first. Only exact for spans that do not overlap with other threads
+            stack = _memory_stack()
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            stack.append([current, 0])
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        peak_bytes = 0
+        if _memory:
+            stack = _memory_stack()
+            start_bytes, peak = stack.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            peak_bytes = peak - start_bytes
+        with _lock:
+            stats = _entry(self.name)
+            stats["calls"] += 1
+            stats["total_s"] += elapsed
+            stats["min_s"] = min(stats["min_s"], elapsed)
+            stats["max_s"] = max(stats["max_s"], elapsed)
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak_bytes)
+        return False
+
+def _memory_stack() -> List[List[int]]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+def _entry(name: str) -> Dict:
+    if name not in _stats:
+        _stats[name] = {"calls": 0, "total_s": 0.0, "min_s": float("inf"), "max_s": 0.0, "peak_bytes": 0, "count": 0}
+    return _stats[name]
+
+def enable(memory: bool = False, format: str = "json"):
+    global _enabled, _memory, _format
+    _enabled, _memory, _format = True, memory, format
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    global _enabled, _memory
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled, _memory = False, False
+
+def enabled() -> bool:
+    return _enabled
+
+def settings() -> Dict:
+    # Handed to worker processes so they record the same way as the parent (see farm.run_farm)
+    return {"enabled": _enabled, "memory": _memory, "format": _format}
+
+def configure(settings: Dict):
+    if settings["enabled"]:
+        enable(settings["memory"], settings["format"])
+    else:
+        disable()
+
+def span(name: str):
+    # with profiler.span("backtest.replay"): ... adds the time (and peak memory) of the block to name
+    return _span(name) if _enabled else _NULL_SPAN
+
+def count(name: str, n: int = 1):
+    # Counter without timing, e.g. cache hits
+    if _enabled:
+        with _lock:
+            _entry(name)["count"] += n
+
+def summary() -> Dict[str, Dict]:
+    # Everything recorded since the last reset, slowest stage first
+    with _lock:
+        rows = {}
+        for name, stats in _stats.items():
+            row = dict(stats)
+            row["mean_s"] = stats["total_s"] / stats["calls"] if stats["calls"] else 0.0
+            if not stats["calls"]:
+                row["min_s"] = 0.0
+            rows[name] = row
+    return dict(sorted(rows.items(), key=lambda item: item[1]["total_s"], reverse=True))
+
+def merge(other: Dict[str, Dict]):
+    # Add a summary recorded elsewhere (another process) to this one
+    with _lock:
+        for name, row in other.items():
+            stats = _entry(name)
+            if row["calls"]:
+                stats["min_s"] = min(stats["min_s"], row["min_s"])
+            stats["calls"] += row["calls"]
+            stats["total_s"] += row["total_s"]
+            stats["max_s"] = max(stats["max_s"], row["max_s"])
+            stats["peak_bytes"] = max(stats["peak_bytes"], row["peak_bytes"])
+            stats["count"] += row["count"]
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def write(path: Path, rows: Dict[str, Dict] = None) -> Path:
+    # Summary as JSON or CSV, by the extension of path
+    rows = summary() if rows is None else rows
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        if path.suffix == ".csv":
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for name, row in rows.items():
+                writer.writerow({"name": name, **{field: row[field] for field in FIELDS[1:]}})
+        else:
+            json.dump(rows, f, indent=4)
+    return path
+
+def report(run_name: str) -> Optional[Path]:
+    # End of a run: write what was recorded to PROFILE_PATH/<run_name>_<time>.<format> and start over.
+    # Does nothing when profiling is off
+    if not _enabled:
+        return None
+    path = write(PROFILE_PATH / f"{run_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{_format}")
+    reset()
+    print(f"Profile written to {path}")
+    return path
+
+if _enabled and _memory:
+    tracemalloc.start()
@@ -0,0 +1,127 @@
+"""Columnar, compressed on-disk store for backtest results."""
+import os
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+RESULTS_PATH = Path("./sattern/src/backtesting_results")
+
+# A result set (e.g. "Testing") is a directory with one sub directory per appended run, run_0, run_1, ...
+# Each run holds one compressed .npz per ticker with a "date" column (int64 ns, UTC, oldest first) and one float
+# column per result column, plus meta.json with the date range and row count of every ticker. meta.json is written
+# last, so a run without it is incomplete and ignored. Reading a ticker only decompresses that ticker's file, and
+# the meta lets a date range skip runs that do not overlap it without opening them
+
+def result_path(name: str) -> Path:
+    return RESULTS_PATH / name
+
+def run_path(name: str, run: int) -> Path:
+    return result_path(name) / f"run_{run}"
+
+def runs(name: str) -> List[Dict]:
+    # meta of every completed run of name, oldest first
+    path = result_path(name)
+    if not path.exists():
+        return []
+    found = []
+    for run_dir in path.glob("run_*"):
+        if (run_dir / "meta.json").exists():
+            with open(run_dir / "meta.json", 'r') as f:
+                found.append(json.load(f))
+    return sorted(found, key=lambda meta: meta["run"])
+
+def _meta(name: str, run: int = None) -> Optional[Dict]:
+    # meta of run, the latest run if None
+    completed = runs(name)
+    if run is None:
+        return completed[-1] if completed else None
+    return next((meta for meta in completed if meta["run"] == run), None)
+
+def _claim_run(name: str) -> int:
+    # Next free run number. Creating the directory claims it, so processes appending at the same time get different runs
+    path = result_path(name)
+    path.mkdir(parents=True, exist_ok=True)
+    run = max([int(run_dir.name[4:]) for run_dir in path.glob("run_*") if run_dir.name[4:].isdigit()], default=-1) + 1
+    while True:
+        try:
+            os.mkdir(run_path(name, run))
+            return run
+        except FileExistsError:
+            run += 1
+
+def append_run(name: str, results: Dict[str, pd.DataFrame], info: Dict = None) -> int:
+    # Save the results of one run, a DataFrame per ticker with a date index and numeric columns (e.g. the
+    # performance_df of Backtester.analyze_performance). info is kept in the meta (periods, dates, ...).
+    # Returns the run number
+    run = _claim_run(name)
+    path = run_path(name, run)
+    tickers: Dict[str, Dict] = {}
+    for ticker, df in results.items():
+        df = df.sort_index()
+        dates = pd.DatetimeIndex(df.index).as_unit("ns").asi8
+        columns = {column: df[column].to_numpy(dtype=float) for column in df.columns}
+        tmp_path = path / f"{ticker}.npz.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, date=dates, **columns)
+        os.replace(tmp_path, path / f"{ticker}.npz")
+        tickers[ticker] = {
+            "rows": len(dates), "first": int(dates[0]) if len(dates) else None, "last": int(dates[-1]) if len(dates) else None,
+            "columns": list(columns),
+        }
+
+    meta = {"run": run, "created": datetime.now(timezone.utc).isoformat(), "info": info or {}, "tickers": tickers}
+    tmp_path = path / "meta.json.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=4)
+    os.replace(tmp_path, path / "meta.json")
+    return run
+
+def read(name: str, ticker: str, start: datetime = None, end: datetime = None, run: int = None, columns: List[str] = None) -> Optional[pd.DataFrame]:
+    # Results of ticker in one run (the latest by default) between start and end (inclusive), oldest first with a
+    # UTC date index. Only the requested columns of that ticker are decompressed. None if the run or ticker is missing
+    meta = _meta(name, run)
+    if meta is None or ticker not in meta["tickers"]:
+        return None
+    ticker_meta = meta["tickers"][ticker]
+    columns = ticker_meta["columns"] if columns is None else columns
+    lo, hi = _bounds(start, end)
+    if ticker_meta["rows"] == 0 or ticker_meta["last"] < lo or ticker_meta["first"] > hi:
+        return _frame(np.zeros(0, dtype=np.int64), {column: np.zeros(0) for column in columns})
+
+    with np.load(run_path(name, meta["run"]) / f"{ticker}.npz") as data:
+        dates = data["date"]
+        first, last = np.searchsorted(dates, lo, side="left"), np.searchsorted(dates, hi, side="right")
+        return _frame(dates[first:last], {column: data[column][first:last] for column in columns})
+
+def read_runs(name: str, ticker: str, start: datetime = None, end: datetime = None, column: str = "Portfolio Value") -> pd.DataFrame:
+    # One column of ticker from every run that has it, side by side (a column per run), for comparing runs.
+    # Runs whose dates do not overlap start and end are skipped without opening their files
+    lo, hi = _bounds(start, end)
+    series = {}
+    for meta in runs(name):
+        ticker_meta = meta["tickers"].get(ticker)
+        if ticker_meta is None or ticker_meta["rows"] == 0 or ticker_meta["last"] < lo or ticker_meta["first"] > hi:
+            continue
+        series[f"run_{meta['run']}"] = read(name, ticker, start, end, meta["run"], [column])[column]
+    return pd.DataFrame(series)
+
+def tickers(name: str, run: int = None) -> List[str]:
+    meta = _meta(name, run)
+    return list(meta["tickers"]) if meta is not None else []
+
+def _bounds(start: datetime, end: datetime) -> Tuple[int, int]:
+    # start and end as int64 ns, open ends are the int64 limits
+    lo = _timestamp(start).value if start is not None else np.iinfo(np.int64).min
+    hi = _timestamp(end).value if end is not None else np.iinfo(np.int64).max
+    return lo, hi
+
+def _timestamp(date: datetime) -> pd.Timestamp:
+    date = pd.Timestamp(date).as_unit("ns")
+    return date.tz_localize("UTC") if date.tzinfo is None else date
+
+def _frame(dates: np.ndarray, columns: Dict[str, np.ndarray]) -> pd.DataFrame:
+    index = pd.DatetimeIndex(np.asarray(dates).view("datetime64[ns]"), name="Date").tz_localize("UTC")
+    return pd.DataFrame(columns, index=index)
@@ -0,0 +1,154 @@
+"""Persistent cache of sattern signal scores, shared by runs and worker processes."""
+import os
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on Windows, concurrent saves of one file can then drop each other's new entries
+    fcntl = None
+
+# The sattern score of a day only depends on the price window it looks back over, so it is stored under a key that
+# hashes the as-of date with that window. A revised or extended history gives new keys instead of stale hits.
+# Each (ticker, mode, period, max_diff) is one .npz of sorted keys and their scores. SATTERN_SIGNAL_CACHE=0 turns
+# the cache off, SATTERN_SIGNAL_CACHE_BYTES bounds its size on disk (least recently used files are evicted first)
+SIGNAL_PATH = Path("./sattern/src/data/signals")
+MAX_BYTES = int(os.getenv("SATTERN_SIGNAL_CACHE_BYTES", 256 * 1024 * 1024))
+
+_enabled: bool = os.getenv("SATTERN_SIGNAL_CACHE", "1") not in ("", "0")
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def enabled() -> bool:
+    return _enabled
+
+def entry_path(ticker: str, mode: str, period: int, max_diff: float) -> Path:
+    # max_diff 2 and 2.0 share a file
+    return SIGNAL_PATH / ticker / f"{mode}_{period}_{float(max_diff):g}.npz"
+
+def action_path(ticker: str, mode: str, period: int, max_diff: float) -> Path:
+    return SIGNAL_PATH / ticker / f"{mode}_{period}_{float(max_diff):g}_action.json"
+
+def window_keys(dates: np.ndarray, prices: np.ndarray, rows: np.ndarray, window_ends: np.ndarray) -> np.ndarray:
+    # One int64 key per day: a hash of its date (int64 ns) and the prices of its window prices[row:window_end]
+    keys = np.zeros(len(rows), dtype=np.int64)
+    if not _enabled:
+        return keys
+    prices = np.ascontiguousarray(prices, dtype=float)
+    for i, (date, row, window_end) in enumerate(zip(np.asarray(dates, dtype=np.int64).tolist(), rows.tolist(), window_ends.tolist())):
+        digest = hashlib.blake2b(prices[row:window_end].tobytes(), digest_size=8, key=date.to_bytes(8, "little", signed=True))
+        keys[i] = int.from_bytes(digest.digest(), "little", signed=True)
+    return keys
+
+def _read(path: Path) -> Tuple[np.ndarray, np.ndarray]:
+    try:
+        with np.load(path) as data:
+            return data["keys"], data["scores"]
+    except (FileNotFoundError, OSError, ValueError, KeyError):
+        # Missing, or evicted while it was being read
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+def lookup(ticker: str, mode: str, period: int, max_diff: float, keys: np.ndarray) -> np.ndarray:
+    # Cached score of each key, NaN where it has not been computed (or the cache is off)
+    scores = np.full(len(keys), np.nan)
+    if not _enabled or len(keys) == 0:
+        return scores
+    path = entry_path(ticker, mode, period, max_diff)
+    cached_keys, cached_scores = _read(path)
+    if len(cached_keys) == 0:
+        return scores
+    positions = np.minimum(np.searchsorted(cached_keys, keys), len(cached_keys) - 1)
+    found = cached_keys[positions] == keys
+    scores[found] = cached_scores[positions[found]]
+    # Marks the file as recently used for eviction
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return scores
+
+def save(ticker: str, mode: str, period: int, max_diff: float, keys: np.ndarray, scores: np.ndarray):
+    # Merge new scores into the cached ones. Writers of the same file take turns on a lock file, the file itself is
+    # replaced atomically so readers never need the lock
+    if not _enabled or len(keys) == 0:
+        return
+    path = entry_path(ticker, mode, period, max_diff)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".lock"), "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        cached_keys, cached_scores = _read(path)
+        # New scores first so they win over cached ones with the same key
+        merged_keys, first = np.unique(np.concatenate((keys, cached_keys)), return_index=True)
+        merged_scores = np.concatenate((scores, cached_scores))[first]
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, keys=merged_keys, scores=merged_scores)
+        os.replace(tmp_path, path)
+    evict()
+
+def lookup_action(ticker: str, mode: str, period: int, max_diff: float, key: int) -> Optional[Dict]:
+    # The whole sattern action (similar periods and prediction included) saved for key, None if there is none
+    if not _enabled:
+        return None
+    try:
+        with open(action_path(ticker, mode, period, max_diff), 'r') as f:
+            saved = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if saved["key"] != int(key):
+        return None
+    action = saved["action"]
+    if "sim_periods" in action:
+        action["sim_periods"] = [(start, diff) for start, diff in action["sim_periods"]]
+    return action
+
+def save_action(ticker: str, mode: str, period: int, max_diff: float, key: int, action: Dict):
+    # Only the action of the latest key is kept, for a rerun over the same bars (see main.run_fund_manager)
+    if not _enabled:
+        return
+    action = dict(action)
+    if "sim_periods" in action:
+        action["sim_periods"] = [[int(start), float(diff)] for start, diff in action["sim_periods"]]
+        action["price_prediction"] = float(action["price_prediction"])
+    path = action_path(ticker, mode, period, max_diff)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump({"key": int(key), "action": action}, f)
+    os.replace(tmp_path, path)
+
+def evict(max_bytes: int = None):
+    # Remove least recently used files until the cache fits in max_bytes
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    if not SIGNAL_PATH.exists():
+        return
+    files: List[Tuple[float, int, Path]] = []
+    for path in SIGNAL_PATH.glob("*/*.npz"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def clear():
+    for path in [*SIGNAL_PATH.glob("*/*.npz"), *SIGNAL_PATH.glob("*/*_action.json")]:
+        path.unlink()
@@ -0,0 +1,55 @@
+"""Check the import time of the entry points against a startup budget."""
+import re
+import sys
+import subprocess
+from typing import Dict, List, Tuple
+
+ENTRY_POINTS = ["sattern.src.main", "sattern.src.backtester", "sattern.src.farm"]
+# Only loaded when something is plotted, sent to the LLM or fetched
+LAZY_MODULES = ["matplotlib", "openai", "dotenv", "requests"]
+# Cumulative import time allowed for each entry point. Mostly pandas and numpy
+BUDGET_MS = 500
+
+def import_times(module: str) -> Dict[str, Tuple[float, float]]:
+    # Self and cumulative import time in ms of every module loaded by `import module`, from python -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True)
+    times: Dict[str, Tuple[float, float]] = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            times[match.group(4)] = (int(match.group(1)) / 1000, int(match.group(2)) / 1000)
+    return times
+
+def measure(module: str, runs: int = 5) -> Tuple[float, Dict[str, Tuple[float, float]]]:
+    # Fastest of several runs, the first one also pays for cold disk caches
+    best_ms, best_times = float("inf"), {}
+    for _ in range(runs):
+        times = import_times(module)
+        if times[module][1] < best_ms:
+            best_ms, best_times = times[module][1], times
+    return best_ms, best_times
+
+def main():
+    failures: List[str] = []
+    print(f"{'Entry point':<24} {'Import (ms)':>12} {'Budget (ms)':>12}  Slowest packages")
+    for module in ENTRY_POINTS:
+        total_ms, times = measure(module)
+        packages: Dict[str, float] = {}
+        for name, (_, cumulative_ms) in times.items():
+            if "." not in name and name != module:
+                packages[name] = max(packages.get(name, 0), cumulative_ms)
+        slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:3]
+        print(f"{module:<24} {total_ms:>12.1f} {BUDGET_MS:>12}  " + ", ".join(f"{name} {ms:.0f}" for name, ms in slowest))
+
+        if total_ms > BUDGET_MS:
+            failures.append(f"{module} took {total_ms:.1f}ms to import, budget is {BUDGET_MS}ms")
+        eager = sorted({name.split(".")[0] for name in times} & set(LAZY_MODULES))
+        if eager:
+            failures.append(f"{module} imports {', '.join(eager)} at startup")
+
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Columnar on-disk store for daily and intraday prices."""
+import os
+import time
+import shutil
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+
+STORE_PATH = Path("./sattern/src/data/prices")
+INTRADAY_PATH = STORE_PATH / "intraday"
+COLUMNS = ["prices", "volume"]
+# Attempts at reading a set of columns that newer writes keep replacing
+READ_ATTEMPTS = 3
+
+# Each ticker is a directory of .npy files, one per column plus "date" (int64 ns, UTC), all stored oldest first so
+# new bars are appended at the end. Files are memory mapped on read, so loading a universe does not parse anything.
+# Intraday bars are kept the same way with a directory per calendar month (INTRADAY_PATH/<interval>/<ticker>/<YYYY-MM>),
+# so a month is ingested on its own and a date range only maps the months it covers.
+# A write puts the whole set of columns in a new generation directory and then points the "current" file at it with
+# one os.replace, so a reader never mixes the columns of two writes. Readers resolve "current" once per read and
+# retry if a newer write removed that generation in the meantime. The mtime of "current" is when the set was written
+
+def ticker_path(ticker: str) -> Path:
+    return STORE_PATH / ticker
+
+def generation_path(path: Path) -> Optional[Path]:
+    # Directory holding the columns of the latest completed write to path, None if there is none
+    try:
+        return path / (path / "current").read_text().strip()
+    except FileNotFoundError:
+        # Stores written before generations keep their columns in path itself
+        return path if (path / "date.npy").exists() else None
+
+def updated(path: Path) -> Optional[datetime]:
+    # Time of the latest completed write to path
+    for name in ["current", "date.npy"]:
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(path / name), tz=timezone.utc)
+        except FileNotFoundError:
+            continue
+    return None
+
+def exists(ticker: str) -> bool:
+    return generation_path(ticker_path(ticker)) is not None
+
+def last_updated(ticker: str) -> Optional[datetime]:
+    return updated(ticker_path(ticker))
+
+def is_fresh(ticker: str, max_age: timedelta) -> bool:
+    updated = last_updated(ticker)
+    return updated is not None and datetime.now(timezone.utc) - updated < max_age
+
+def read(ticker: str, mmap: bool = True) -> Optional[Dict[str, np.ndarray]]:
+    # Columns of a ticker, oldest first. None if the ticker is not stored
+    return read_columns(ticker_path(ticker), mmap)
+
+def read_columns(path: Path, mmap: bool = True, columns: List[str] = COLUMNS) -> Optional[Dict[str, np.ndarray]]:
+    mmap_mode = "r" if mmap else None
+    for _ in range(READ_ATTEMPTS):
+        generation = generation_path(path)
+        if generation is None:
+            return None
+        try:
+            values = {column: np.load(generation / f"{column}.npy", mmap_mode=mmap_mode) for column in ["date", *columns]}
+        except FileNotFoundError:
+            # Replaced by a newer write while reading, read that one instead
+            continue
+        if len({len(column_values) for column_values in values.values()}) != 1:
+            return None
+        return values
+    return None
+
+def read_frame(ticker: str) -> Optional[pd.DataFrame]:
+    # Same layout as api.get_prices: newest first, UTC date index
+    columns = read(ticker)
+    if columns is None:
+        return None
+    index = pd.DatetimeIndex(columns["date"][::-1].view("datetime64[ns]"), name="date").tz_localize("UTC")
+    return pd.DataFrame({column: columns[column][::-1] for column in COLUMNS}, index=index)
+
+def last_date(ticker: str) -> Optional[pd.Timestamp]:
+    columns = read(ticker)
+    if columns is None or len(columns["date"]) == 0:
+        return None
+    return pd.Timestamp(int(columns["date"][-1]), tz="UTC")
+
+def write(ticker: str, df: pd.DataFrame, fetched: datetime = None):
+    # Replace the stored history of a ticker with df (any order). fetched is when df was fetched, default now
+    write_columns(ticker_path(ticker), df, fetched)
+
+def write_columns(path: Path, df: pd.DataFrame, fetched: datetime = None):
+    df = df.sort_index()
+    path.mkdir(parents=True, exist_ok=True)
+    columns = {column: df[column].to_numpy(dtype=float) for column in COLUMNS}
+    columns["date"] = df.index.as_unit("ns").asi8
+    # Generations are named by write time so older ones sort first
+    generation = f"{time.time_ns():020d}.{os.getpid()}"
+    (path / generation).mkdir()
+    for column in ["date", *COLUMNS]:
+        with open(path / generation / f"{column}.npy", "wb") as f:
+            np.save(f, columns[column])
+    tmp_path = path / f"current.{os.getpid()}.tmp"
+    tmp_path.write_text(generation)
+    if fetched is not None:
+        os.utime(tmp_path, (fetched.timestamp(), fetched.timestamp()))
+    os.replace(tmp_path, path / "current")
+    # Generations older than the current one, and the columns of a store from before generations. Readers that
+    # still map them keep their data, and ones that open them too late retry with the current generation
+    current = generation_path(path).name
+    for entry in path.iterdir():
+        if entry.is_dir() and entry.name < current:
+            shutil.rmtree(entry, ignore_errors=True)
+        elif entry.suffix == ".npy":
+            entry.unlink(missing_ok=True)
+
+def append(ticker: str, df: pd.DataFrame) -> int:
+    # Add the bars of df that are newer than the stored history. Returns the number of bars added
+    columns = read(ticker, mmap=False)
+    if columns is None:
+        write(ticker, df)
+        return len(df)
+    new_bars = df[df.index.as_unit("ns").asi8 > (columns["date"][-1] if len(columns["date"]) else np.iinfo(np.int64).min)].sort_index()
+    merged = {column: np.concatenate((columns[column], new_bars[column].to_numpy(dtype=float))) for column in COLUMNS}
+    index = pd.DatetimeIndex(np.concatenate((columns["date"], new_bars.index.as_unit("ns").asi8)).view("datetime64[ns]"), name="date").tz_localize("UTC")
+    write(ticker, pd.DataFrame(merged, index=index))
+    return len(new_bars)
+
+def month_path(ticker: str, interval: str, month: str) -> Path:
+    return INTRADAY_PATH / interval / ticker / month
+
+def months(ticker: str, interval: str) -> List[str]:
+    # Stored months of a ticker ("YYYY-MM"), oldest first
+    path = INTRADAY_PATH / interval / ticker
+    if not path.exists():
+        return []
+    return sorted(month_dir.name for month_dir in path.iterdir() if generation_path(month_dir) is not None)
+
+def month_updated(ticker: str, interval: str, month: str) -> Optional[datetime]:
+    return updated(month_path(ticker, interval, month))
+
+def write_month(ticker: str, interval: str, month: str, df: pd.DataFrame):
+    # Replace the bars of one month
+    write_columns(month_path(ticker, interval, month), df)
+
+def iter_intraday(ticker: str, interval: str, start: datetime = None, end: datetime = None, columns: List[str] = COLUMNS) -> Iterator[Dict[str, np.ndarray]]:
+    # Memory mapped columns of each stored month between start and end (inclusive), oldest first, one month at a
+    # time. Months outside the range are never opened, so memory is bounded by a month whatever the history length
+    lo = _ns(start) if start is not None else np.iinfo(np.int64).min
+    hi = _ns(end) if end is not None else np.iinfo(np.int64).max
+    # Months are exchange months, a day of slack covers bars whose UTC time falls in the neighbouring month
+    first_month = (pd.Timestamp(lo, tz="UTC") - timedelta(days=1)).strftime("%Y-%m") if start is not None else ""
+    last_month = (pd.Timestamp(hi, tz="UTC") + timedelta(days=1)).strftime("%Y-%m") if end is not None else "9999-99"
+    for month in months(ticker, interval):
+        if not first_month <= month <= last_month:
+            continue
+        values = read_columns(month_path(ticker, interval, month), columns=columns)
+        if values is None:
+            continue
+        first, last = np.searchsorted(values["date"], lo, side="left"), np.searchsorted(values["date"], hi, side="right")
+        if last > first:
+            yield {column: column_values[first:last] for column, column_values in values.items()}
+
+def read_intraday(ticker: str, interval: str, start: datetime = None, end: datetime = None, columns: List[str] = COLUMNS) -> Dict[str, np.ndarray]:
+    # Columns between start and end joined into one array each, oldest first. Only the months in range are read
+    chunks = list(iter_intraday(ticker, interval, start, end, columns))
+    if len(chunks) == 0:
+        return {column: np.zeros(0, dtype=np.int64 if column == "date" else float) for column in ["date", *columns]}
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in ["date", *columns]}
+
+def read_intraday_frame(ticker: str, interval: str, start: datetime = None, end: datetime = None, columns: List[str] = COLUMNS) -> pd.DataFrame:
+    # Same layout as api.get_prices: newest first, UTC date index
+    values = read_intraday(ticker, interval, start, end, columns)
+    index = pd.DatetimeIndex(values["date"][::-1].view("datetime64[ns]"), name="date").tz_localize("UTC")
+    return pd.DataFrame({column: values[column][::-1] for column in columns}, index=index)
+
+def _ns(date: datetime) -> int:
+    date = pd.Timestamp(date)
+    date = date.tz_localize("UTC") if date.tzinfo is None else date
+    return date.as_unit("ns").value
@@ -0,0 +1,215 @@
+"""Online sattern state that is updated one bar at a time."""
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List, Tuple
+from sattern.src import process, profiler
+
+STATE_PATH = Path("./sattern/src/data/sattern_state")
+
+class SatternState():
+    # process.sattern over a growing price history without rescanning it.
+    # Diffs are kept oldest first. The template is the <period> diffs before the newest one, and a window <lag>
+    # positions older is compared to it element by element. When a bar arrives the template moves forward by one,
+    # so every lag keeps all but its oldest comparison and gains one new one. run[lag] counts how many of the latest
+    # comparisons in a row are within max_diff (capped at period), so a bar costs one vectorized comparison per
+    # lag. Only lags whose whole window is within max_diff (run == period) have their cumulative difference
+    # checked, which is O(period) each. A bar is therefore O(history + period * candidates): the run update is a
+    # single numpy pass over every lag, since any lag can start a run, and only the cumulative check is bounded
+    # by the candidates. The greedy selection and the forecast are the same as process.sattern
+    def __init__(self, period: int = 10, max_diff: float = 2, capacity: int = 1024):
+        self.period = period
+        self.max_diff = max_diff
+        self.size = 0
+        self.dates = np.empty(capacity, dtype=np.int64)
+        self.prices = np.empty(capacity, dtype=float)
+        # diffs[i] is the move from bar i to bar i + 1, runs is indexed by lag
+        self.diffs = np.empty(capacity, dtype=float)
+        self.runs = np.zeros(capacity, dtype=np.int32)
+        # history_digest of the ingested bars, computed when first needed after a change
+        self._digest = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _reserve(self, size: int):
+        # Grow the buffers by doubling, so appending a bar is amortized O(1)
+        if size <= len(self.prices):
+            return
+        capacity = max(size, 2 * len(self.prices))
+        for name in ["dates", "prices", "diffs", "runs"]:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = history_digest(self.dates[:self.size], self.prices[:self.size])
+        return self._digest
+
+    def same_history(self, prices: pd.DataFrame) -> bool:
+        # Whether the bars of prices (laid out like api.get_prices) up to the last ingested one are exactly the
+        # ingested bars. A revised close or a split adjustment changes the runs of every lag that compares it
+        df = prices.iloc[::-1]
+        dates = df.index.as_unit("ns").asi8
+        count = np.searchsorted(dates, self.dates[self.size - 1], side="right") if self.size else 0
+        return history_digest(dates[:count], df["prices"].to_numpy(dtype=float)[:count]) == self.digest
+
+    @property
+    def last_date(self) -> pd.Timestamp:
+        return pd.Timestamp(int(self.dates[self.size - 1]), tz="UTC") if self.size else None
+
+    def lag_range(self) -> Tuple[int, int]:
+        # Lags compared by find_similar_periods for the current history: start s of a window is lag + period + 1
+        return self.period - 1, self.size - 3 - self.period
+
+    def _window_runs(self, lags: np.ndarray) -> np.ndarray:
+        # run of each lag computed from scratch, used for the initial history and the lag each bar adds
+        n_diffs, period = self.size - 1, self.period
+        template_start = n_diffs - 1 - period
+        if len(lags) == 0 or template_start < 0:
+            return np.zeros(len(lags), dtype=np.int32)
+        j = np.arange(period)
+        template = self.diffs[template_start + j]
+        ok = np.abs(template - self.diffs[template_start - lags[:, None] + j]) <= self.max_diff
+        # Number of trailing comparisons that are within max_diff
+        failed = ~ok[:, ::-1]
+        return np.where(failed.any(axis=1), failed.argmax(axis=1), period).astype(np.int32)
+
+    def add(self, date: pd.Timestamp, price: float) -> bool:
+        # Ingest one bar. Bars that are not newer than the last one are ignored, so a history can be replayed
+        date = pd.Timestamp(date)
+        date = date.tz_localize("UTC") if date.tzinfo is None else date
+        date_value = date.as_unit("ns").value
+        if self.size and date_value <= self.dates[self.size - 1]:
+            return False
+        self._reserve(self.size + 1)
+        self.dates[self.size], self.prices[self.size] = date_value, price
+        self.size += 1
+        self._digest = None
+        if self.size < 2:
+            return True
+        self.diffs[self.size - 2] = self.prices[self.size - 1] - self.prices[self.size - 2]
+
+        # The template now ends at the diff that used to be the newest one, each lag compares it to the diff <lag>
+        # positions before it
+        first_lag, last_lag = self.lag_range()
+        n_diffs = self.size - 1
+        if last_lag >= first_lag:
+            template_end = n_diffs - 2
+            lags = np.arange(first_lag, last_lag)
+            ok = np.abs(self.diffs[template_end] - self.diffs[template_end - lags]) <= self.max_diff
+            self.runs[first_lag:last_lag] = np.where(ok, np.minimum(self.runs[first_lag:last_lag] + 1, self.period), 0)
+            # The oldest lag is new with this bar
+            self.runs[last_lag] = self._window_runs(np.array([last_lag]))[0]
+        return True
+
+    def add_frame(self, prices: pd.DataFrame) -> int:
+        # Ingest the bars of prices (laid out like api.get_prices, newest first) that are newer than the last bar.
+        # An empty state takes the whole history at once. Returns the number of bars added
+        df = prices.iloc[::-1]
+        dates = df.index.as_unit("ns").asi8
+        values = df["prices"].to_numpy(dtype=float)
+        new = dates > self.dates[self.size - 1] if self.size else np.ones(len(dates), dtype=bool)
+        if self.size == 0 and new.sum() > 0:
+            dates, values = dates[new], values[new]
+            self._reserve(len(values))
+            self.dates[:len(values)], self.prices[:len(values)] = dates, values
+            self.size = len(values)
+            self._digest = None
+            self.diffs[:self.size - 1] = np.diff(values)
+            first_lag, last_lag = self.lag_range()
+            if last_lag >= first_lag:
+                lags = np.arange(first_lag, last_lag + 1)
+                self.runs[lags] = self._window_runs(lags)
+            return self.size
+        count = 0
+        for date, value in zip(dates[new], values[new]):
+            count += self.add(pd.Timestamp(int(date), tz="UTC"), value)
+        return count
+
+    def similar_periods(self) -> List[Tuple[int, float]]:
+        # find_similar_periods of the current history, from the lags whose run covers the whole window
+        first_lag, last_lag = self.lag_range()
+        if last_lag < first_lag:
+            return []
+        candidates = first_lag + np.flatnonzero(self.runs[first_lag:last_lag + 1] >= self.period)
+        if len(candidates) == 0:
+            return []
+        # Oldest window first, like the greedy scan
+        candidates = candidates[::-1]
+        n_diffs, period = self.size - 1, self.period
+        template_start = n_diffs - 1 - period
+        j = np.arange(period)
+        comp_diff = self.diffs[template_start + j] - self.diffs[template_start - candidates[:, None] + j]
+        comp_cum_diff = np.cumsum(comp_diff, axis=1)
+        matches = (np.abs(comp_cum_diff) <= self.max_diff).all(axis=1)
+        return process.select_similar_periods(candidates + period + 1, matches, comp_cum_diff[:, -1], period)
+
+    def newest_first(self) -> Tuple[pd.DatetimeIndex, np.ndarray, np.ndarray]:
+        # Dates, prices and diffs in the layout process.sattern works on, as views of the buffers
+        dates = pd.DatetimeIndex(self.dates[:self.size][::-1].view("datetime64[ns]")).tz_localize("UTC")
+        return dates, self.prices[:self.size][::-1], self.diffs[:self.size - 1][::-1]
+
+    def action(self) -> Dict:
+        # Same as process.sattern_multi(prices, [period], max_diff)[period]
+        similar_periods = self.similar_periods()
+        if len(similar_periods) == 0:
+            return {"action": "Hold"}
+        _, prices, diffs = self.newest_first()
+        prediction = process.sattern_prediction(prices, diffs, similar_periods, self.period, self.max_diff)
+        return process.sattern_action(prices, similar_periods, prediction)
+
+    def sattern(self) -> Tuple[pd.DataFrame, Dict]:
+        # Same as process.sattern(prices, period, max_diff): the highlight/prediction DataFrame and the action
+        dates, prices, diffs = self.newest_first()
+        return process.sattern_result(dates, prices, diffs, self.similar_periods(), self.period, self.max_diff)
+
+    def save(self, path: Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f, period=self.period, max_diff=self.max_diff, dates=self.dates[:self.size], prices=self.prices[:self.size],
+                diffs=self.diffs[:max(self.size - 1, 0)], runs=self.runs[:self.size], digest=self.digest,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "SatternState":
+        with np.load(path) as data:
+            state = cls(int(data["period"]), float(data["max_diff"]), capacity=max(2 * len(data["prices"]), 1024))
+            state.size = len(data["prices"])
+            state.dates[:state.size], state.prices[:state.size] = data["dates"], data["prices"]
+            state.diffs[:len(data["diffs"])] = data["diffs"]
+            state.runs[:len(data["runs"])] = data["runs"]
+            state._digest = str(data["digest"]) if "digest" in data else None
+        return state
+
+def history_digest(dates: np.ndarray, prices: np.ndarray) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(dates, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(prices, dtype=float).tobytes())
+    return digest.hexdigest()
+
+def state_path(ticker: str, period: int, max_diff: float) -> Path:
+    # Same formatting as signal_cache.entry_path, so max_diff 2 and 2.0 share a state
+    return STATE_PATH / f"{ticker}_{period}_{float(max_diff):g}.npz"
+
+def update_state(ticker: str, prices: pd.DataFrame, period: int = 10, max_diff: float = 2) -> SatternState:
+    # Load the saved state of ticker, ingest the bars of prices it has not seen and save it again. A state whose
+    # bars no longer match prices (the history was revised) is rebuilt from prices
+    path = state_path(ticker, period, max_diff)
+    state = SatternState.load(path) if path.exists() else SatternState(period, max_diff)
+    rebuilt = len(state) > 0 and not state.same_history(prices)
+    if rebuilt:
+        profiler.count("stream.rebuild")
+        state = SatternState(period, max_diff)
+    if state.add_frame(prices) or rebuilt:
+        state.save(path)
+    return state
@@ -0,0 +1,173 @@
+"""Parameter sweeps and walk-forward evaluation of the backtest."""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import product
+from typing import Dict, List, Tuple, Union
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from sattern.src import trader, signal_cache
+from sattern.src.backtester import Backtester, sattern_scores, performance_metrics
+
+DEFAULT_THRESHOLDS = (0.8, 0.25, -0.25, -0.8)
+# One grid point: the sattern periods traded together, max_diff and the combine_signal_scores thresholds
+Cell = Tuple[Tuple[int, ...], float, Tuple[float, float, float, float]]
+
+def grid(periods: List[Union[int, List[int]]], max_diffs: List[float], thresholds: List[Tuple[float, float, float, float]]) -> List[Cell]:
+    # Every combination. An entry of periods is one period or a list of periods whose signals are combined
+    period_sets = [tuple(entry) if isinstance(entry, (list, tuple)) else (entry,) for entry in periods]
+    return [(period_set, max_diff, tuple(threshold)) for period_set, max_diff, threshold in product(period_sets, max_diffs, thresholds)]
+
+def signal_matrices(backtester: Backtester, periods: List[int], max_diffs: List[float], max_workers: int = 1) -> Dict[float, pd.DataFrame]:
+    # Backtester.signal_matrix for every max_diff, with a sattern column for each of periods. Each trading day is
+    # matched once per max_diff for all periods together (sattern_multi shares the diffs and prefix sums), the news
+    # and insider columns are computed once, and the (max_diff, chunk of days) jobs run in parallel. Days found in
+    # the signal cache are not matched again
+    dates, rows, window_ends = backtester.trading_windows()
+    prices = backtester.prices["prices"].to_numpy(dtype=float)
+    context = backtester.context_signals(dates)
+    keys = signal_cache.window_keys(dates.as_unit("ns").asi8, prices, rows, window_ends)
+
+    scores: Dict[float, Dict[str, np.ndarray]] = {}
+    jobs = []
+    for max_diff in max_diffs:
+        scores[max_diff] = {f"sattern_{period}": signal_cache.lookup(backtester.ticker, backtester.mode, period, max_diff, keys) for period in periods}
+        missing = np.flatnonzero(np.isnan(np.column_stack(list(scores[max_diff].values()))).any(axis=1))
+        jobs += [(max_diff, chunk) for chunk in np.array_split(missing, max(max_workers, 1)) if len(chunk)]
+
+    if max_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = []
+            for max_diff, chunk in jobs:
+                # Only send each worker the slice of history its days look back over
+                first, last = rows[chunk].min(), window_ends[chunk].max()
+                futures.append(pool.submit(sattern_scores, prices[first:last], rows[chunk] - first, window_ends[chunk] - first, periods, max_diff, backtester.mode))
+            parts = [future.result() for future in futures]
+    else:
+        parts = [sattern_scores(prices, rows[chunk], window_ends[chunk], periods, max_diff, backtester.mode) for max_diff, chunk in jobs]
+
+    for (max_diff, chunk), part in zip(jobs, parts):
+        for column, values in part.items():
+            scores[max_diff][column][chunk] = values
+    for max_diff in max_diffs:
+        chunks = [chunk for job_max_diff, chunk in jobs if job_max_diff == max_diff]
+        if len(chunks) == 0:
+            continue
+        computed = np.concatenate(chunks)
+        for period in periods:
+            signal_cache.save(backtester.ticker, backtester.mode, period, max_diff, keys[computed], scores[max_diff][f"sattern_{period}"][computed])
+
+    matrices: Dict[float, pd.DataFrame] = {}
+    for max_diff in max_diffs:
+        signals = dict(scores[max_diff])
+        signals.update(context)
+        matrices[max_diff] = pd.DataFrame(signals, index=dates)
+    return matrices
+
+def evaluate(signals: pd.DataFrame, prices: np.ndarray, cell: Cell, init_capital: float, periods_per_year: float = 252) -> Dict[str, float]:
+    # Backtester.replay of one grid point on a slice of days, reduced to the analyze_performance metrics.
+    # prices are the closing prices of the days in signals, periods_per_year the number of those days in a year
+    period_set, _, thresholds = cell
+    columns = [f"sattern_{period}" for period in period_set] + [column for column in signals.columns if not column.startswith("sattern_")]
+    action_codes, quantities = trader.combine_signal_scores(signals[columns].to_numpy(dtype=float), prices, thresholds=thresholds)
+    _, cash, stock = trader.replay_trades(action_codes, quantities, prices, init_capital, 0)
+    return performance_metrics(cash + stock * prices, init_capital, periods_per_year)
+
+def evaluate_cells(matrices: Dict[float, pd.DataFrame], prices: np.ndarray, cells: List[Cell], splits: List[Tuple[slice, slice]], init_capital: float, periods_per_year: float = 252) -> Tuple[List[Dict[str, float]], List[List[Dict[str, float]]]]:
+    # evaluate of each cell over the whole backtest and on the train rows of each split
+    full = [evaluate(matrices[cell[1]], prices, cell, init_capital, periods_per_year) for cell in cells]
+    train = [[evaluate(matrices[cell[1]].iloc[train_rows], prices[train_rows], cell, init_capital, periods_per_year) for train_rows, _ in splits] for cell in cells]
+    return full, train
+
+def walk_forward_splits(dates: pd.DatetimeIndex, train: timedelta, test: timedelta) -> List[Tuple[slice, slice]]:
+    # Rolling (train, test) row slices of dates: each test window follows the train window before it and the
+    # next split starts one test window later. Test windows do not overlap and together cover the backtest
+    # from the end of the first train window
+    splits: List[Tuple[slice, slice]] = []
+    if len(dates) == 0:
+        return splits
+    test_start = dates[0] + train
+    while test_start <= dates[-1]:
+        train_rows = slice(dates.searchsorted(test_start - train), dates.searchsorted(test_start))
+        test_rows = slice(dates.searchsorted(test_start), dates.searchsorted(test_start + test))
+        if test_rows.stop > test_rows.start and train_rows.stop > train_rows.start:
+            splits.append((train_rows, test_rows))
+        test_start = test_start + test
+    return splits
+
+def cell_columns(cell: Cell) -> Dict:
+    period_set, max_diff, thresholds = cell
+    return {"periods": list(period_set), "max_diff": max_diff, "thresholds": list(thresholds)}
+
+def run_sweep(backtester: Backtester, cells: List[Cell], train: timedelta = timedelta(days=365), test: timedelta = timedelta(days=90), metric: str = "sharpe_ratio", max_workers: int = 1) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # Evaluate every cell over the whole backtest, then walk forward: on each train window pick the cell with the
+    # best metric and score it on the following test window.
+    # Returns (one row of metrics per cell, one row per walk-forward split)
+    periods = sorted({period for period_set, _, _ in cells for period in period_set})
+    max_diffs = sorted({max_diff for _, max_diff, _ in cells})
+    matrices = signal_matrices(backtester, periods, max_diffs, max_workers)
+    dates = matrices[max_diffs[0]].index
+    prices = backtester.prices["prices"].loc[dates].to_numpy(dtype=float)
+    # Metrics are annualized over the trading bars, every <every>-th bar of an intraday backtest
+    periods_per_year = 252 * backtester.bars_per_day / backtester.every
+    splits = walk_forward_splits(dates, train, test)
+
+    # Cells are evaluated in chunks, each worker only gets the signal matrices of its own cells
+    if max_workers > 1 and len(cells) > 1:
+        chunks = [chunk for chunk in np.array_split(np.arange(len(cells)), max_workers) if len(chunk)]
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = []
+            for chunk in chunks:
+                chunk_cells = [cells[i] for i in chunk]
+                chunk_matrices = {cell[1]: matrices[cell[1]] for cell in chunk_cells}
+                futures.append(pool.submit(evaluate_cells, chunk_matrices, prices, chunk_cells, splits, backtester.init_capital, periods_per_year))
+            parts = [future.result() for future in futures]
+        full_metrics = [metrics for part in parts for metrics in part[0]]
+        train_metrics = [metrics for part in parts for metrics in part[1]]
+    else:
+        full_metrics, train_metrics = evaluate_cells(matrices, prices, cells, splits, backtester.init_capital, periods_per_year)
+    grid_rows = [{**cell_columns(cell), **metrics} for cell, metrics in zip(cells, full_metrics)]
+
+    split_rows = []
+    for split, (train_rows, test_rows) in enumerate(splits):
+        # A NaN metric (a window too short for a Sharpe ratio) is never the best, a split where every cell has
+        # one has nothing to pick and is left out
+        values = np.array([cell_metrics[split][metric] for cell_metrics in train_metrics], dtype=float)
+        if np.isnan(values).all():
+            continue
+        best = int(np.nanargmax(values))
+        test_metrics = evaluate(matrices[cells[best][1]].iloc[test_rows], prices[test_rows], cells[best], backtester.init_capital, periods_per_year)
+        split_rows.append({
+            "train_start": dates[train_rows.start], "train_end": dates[train_rows.stop - 1],
+            "test_start": dates[test_rows.start], "test_end": dates[test_rows.stop - 1],
+            **cell_columns(cells[best]),
+            f"train_{metric}": float(values[best]),
+            **{f"test_{name}": value for name, value in test_metrics.items()},
+        })
+
+    return pd.DataFrame(grid_rows).sort_values(metric, ascending=False, ignore_index=True), pd.DataFrame(split_rows)
+
+def main():
+    start = datetime.now() - timedelta(days=365*4)
+    end = datetime.now()
+    ticker = "ERJ"
+    save_name = "Sweep"
+
+    cells = grid(
+        periods=[5, 10, 20, [5, 10, 20]],
+        max_diffs=[1, 2, 3],
+        thresholds=[DEFAULT_THRESHOLDS, (0.6, 0.2, -0.2, -0.6), (0.9, 0.4, -0.4, -0.9)],
+    )
+    backtester = Backtester(ticker, start, end, 10000, display=False, periods=[5, 10, 20])
+    grid_results, walk_forward = run_sweep(backtester, cells, max_workers=4)
+    print(grid_results.head(10).to_string())
+    print(walk_forward.to_string())
+    if len(walk_forward):
+        compounded = (np.prod(1 + walk_forward['test_total_return'] / 100) - 1) * 100
+        print(f"\nWalk-forward test return: {compounded:.2f}% over {len(walk_forward)} splits")
+
+    grid_results.to_csv(f'{Path("./sattern/src/backtesting_results")}/{save_name}_grid.csv', index=False)
+    walk_forward.to_csv(f'{Path("./sattern/src/backtesting_results")}/{save_name}_walk_forward.csv', index=False)
+
+if __name__ == "__main__":
+    main()
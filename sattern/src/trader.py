@@ -1,5 +1,12 @@
 """Executes stock trades."""
-from typing import Dict, Union
+from typing import Dict, List, Union, Tuple
+import numpy as np
+import pandas as pd
+
+# Score of each action when signals are combined, and the action for each code used by the vectorized replay
+SIGNAL_SCORES: Dict[str, float] = {"Strong Buy": 1, "Buy": 0.5, "Hold": 0, "Sell": -0.5, "Strong Sell": -1}
+ACTIONS = ["Strong Sell", "Sell", "Hold", "Buy", "Strong Buy"]
+HOLD = ACTIONS.index("Hold")
 
 class portfolio():
     def __init__(self, cash: int = 10000, stock: int = 0, display: bool = False):
@@ -42,6 +49,27 @@ class portfolio():
     def __str__(self) -> str:
         return f"Portfolio(cash={self.cash:.2f}, stock={self.stock})"
 
+class multi_portfolio():
+    # Positions in many tickers on one shared cash balance. stock holds the shares of each ticker, in the order of tickers
+    def __init__(self, tickers: List[str], cash: float = 10000, stock: np.ndarray = None):
+        self.tickers = list(tickers)
+        self.cash = cash
+        self.stock = np.zeros(len(self.tickers)) if stock is None else np.asarray(stock, dtype=float)
+
+    def execute_trades(self, action_codes: np.ndarray, quantities: np.ndarray, curr_prices: np.ndarray) -> np.ndarray:
+        # One day of trades for every ticker at once (see execute_day). Returns the executed quantities
+        executed, self.cash = execute_day(action_codes, quantities, curr_prices, self.cash, self.stock)
+        self.stock += executed
+        return executed
+
+    def value(self, curr_prices: np.ndarray) -> float:
+        # Tickers without a price are valued at 0
+        return self.cash + float(np.nansum(self.stock * curr_prices))
+
+    def __str__(self) -> str:
+        positions = ", ".join(f"{ticker}={stock:g}" for ticker, stock in zip(self.tickers, self.stock) if stock)
+        return f"Portfolio(cash={self.cash:.2f}, stock={{{positions}}})"
+
 def combine_signals(actions: Dict, curr_price: float) -> tuple:
     # Set the amounts to buy
     strong_signal_quantity = 10000//curr_price
@@ -84,4 +112,94 @@ def combine_signals(actions: Dict, curr_price: float) -> tuple:
             string += f"{metric}: {actions[metric]}"
         print(f"\t{action} {quantity} -- Individual Actions: {string}\n")
 
-    return action, quantity
\ No newline at end of file
+    return action, quantity
+
+def signal_score(action: str) -> float:
+    # Anything that is not a recognised action counts as a Hold, same as combine_signals
+    return SIGNAL_SCORES.get(action, 0)
+
+def combine_signal_scores(scores: np.ndarray, curr_prices: np.ndarray, budget: float = 10000, thresholds: Tuple[float, float, float, float] = (0.8, 0.25, -0.25, -0.8)) -> Tuple[np.ndarray, np.ndarray]:
+    # combine_signals for every day at once. scores is days x metrics of signal_score values, or days x tickers x
+    # metrics with curr_prices days x tickers. Metrics that are NaN are left out of the average (a ticker with fewer
+    # signals), a day without any is a Hold. Returns the action code (index into ACTIONS) and quantity for each day
+    strong_signal_quantity = budget // curr_prices
+    normal_signal_quantity = strong_signal_quantity // 2
+    valid = np.isfinite(scores)
+    metric_avg = np.where(valid, scores, 0).sum(axis=-1) / np.maximum(valid.sum(axis=-1), 1)
+
+    strong_buy, buy, sell, strong_sell = thresholds
+    action_codes = np.select(
+        [metric_avg >= strong_buy, metric_avg >= buy, metric_avg > sell, metric_avg > strong_sell],
+        [ACTIONS.index("Strong Buy"), ACTIONS.index("Buy"), HOLD, ACTIONS.index("Sell")],
+        ACTIONS.index("Strong Sell")
+    )
+    quantities = np.select(
+        [action_codes == ACTIONS.index("Strong Buy"), action_codes == ACTIONS.index("Buy"), action_codes == HOLD, action_codes == ACTIONS.index("Sell")],
+        [strong_signal_quantity, normal_signal_quantity, 0, -1 * normal_signal_quantity],
+        -1 * strong_signal_quantity
+    )
+    return action_codes, quantities
+
+def replay_trades(action_codes: np.ndarray, quantities: np.ndarray, curr_prices: np.ndarray, cash: float, stock: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Apply the cash and stock limits of portfolio.execute_trade to a sequence of trades.
+    # Each trade depends on the cash and stock left by the previous one, so this is a single scan over plain floats.
+    # Returns the executed quantity, cash and stock after each day
+    executed = np.empty(len(curr_prices))
+    cash_values = np.empty(len(curr_prices))
+    stock_values = np.empty(len(curr_prices))
+    for i, (code, quantity, current_price) in enumerate(zip(action_codes.tolist(), quantities.tolist(), curr_prices.tolist())):
+        if code > HOLD and abs(quantity) * current_price > cash:
+            quantity = cash // current_price
+        elif code < HOLD:
+            quantity = -1 * abs(min(abs(quantity), stock))
+
+        stock += quantity
+        cash -= quantity * current_price
+        executed[i], cash_values[i], stock_values[i] = quantity, cash, stock
+    return executed, cash_values, stock_values
+
+def execute_day(action_codes: np.ndarray, quantities: np.ndarray, curr_prices: np.ndarray, cash: float, stock: np.ndarray) -> Tuple[np.ndarray, float]:
+    # The limits of portfolio.execute_trade for one day of trades in many tickers sharing cash. Tickers without a
+    # price (NaN) do not trade. Sells are capped by the shares held and go first, so their cash is available to the
+    # buys. Buys are filled strongest action first (then in ticker order) while the cash lasts, the first one that
+    # does not fit buys what is left of the cash like execute_trade does and the ones after it buy nothing.
+    # Returns the executed quantity of each ticker and the cash left
+    tradable = np.isfinite(curr_prices)
+    executed = np.zeros(len(curr_prices))
+
+    sells = tradable & (action_codes < HOLD)
+    executed[sells] = -np.minimum(np.abs(quantities[sells]), stock[sells])
+    cash -= float(executed[sells] @ curr_prices[sells])
+
+    buys = np.flatnonzero(tradable & (action_codes > HOLD))
+    if len(buys):
+        buys = buys[np.argsort(-action_codes[buys], kind="stable")]
+        costs = np.cumsum(np.abs(quantities[buys]) * curr_prices[buys])
+        filled = int(np.searchsorted(costs, cash, side="right"))
+        executed[buys[:filled]] = quantities[buys[:filled]]
+        spent = float(costs[filled - 1]) if filled else 0.0
+        if filled < len(buys):
+            executed[buys[filled]] = (cash - spent) // curr_prices[buys[filled]]
+        cash -= float(executed[buys] @ curr_prices[buys])
+    return executed, cash
+
+def replay_portfolio(action_codes: np.ndarray, quantities: np.ndarray, curr_prices: np.ndarray, cash: float, stock: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # replay_trades for days x tickers of trades on one shared cash balance: a vectorized execute_day per day.
+    # Returns the executed quantities (days x tickers), cash after each day and stock after each day (days x tickers)
+    days, n_tickers = curr_prices.shape
+    stock = np.zeros(n_tickers) if stock is None else np.array(stock, dtype=float)
+    executed = np.zeros((days, n_tickers))
+    cash_values = np.empty(days)
+    stock_values = np.empty((days, n_tickers))
+    for i in range(days):
+        executed[i], cash = execute_day(action_codes[i], quantities[i], curr_prices[i], cash, stock)
+        stock += executed[i]
+        cash_values[i], stock_values[i] = cash, stock
+    return executed, cash_values, stock_values
+
+def align_prices(prices: Dict[str, pd.DataFrame], dates: pd.DatetimeIndex = None) -> pd.DataFrame:
+    # Closing prices of every ticker (laid out like api.get_prices) on a common calendar, oldest first with a column
+    # per ticker. The calendar is every date any ticker traded unless dates is given, NaN where a ticker has no bar
+    columns = {ticker: df["prices"].iloc[::-1] for ticker, df in prices.items()}
+    aligned = pd.DataFrame(columns).sort_index()
+    return aligned if dates is None else aligned.reindex(dates)
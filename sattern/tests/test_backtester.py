@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import datetime, timedelta
+from sattern.src.backtester import Backtester
+
+def synthetic_prices() -> pd.DataFrame:
+    # Moves too large to match by chance. The five moves before 2024-03-07 are repeated right after the bar 730 days
+    # earlier, so sattern_5 only finds a match (a Strong Buy) on that day if its lookback window includes that bar
+    rng = np.random.default_rng(0)
+    index = pd.bdate_range(end="2024-03-28", periods=800, tz="UTC", name="date").as_unit("ns")
+    diffs = np.round(rng.normal(0, 6, len(index) - 1), 2)
+    day = index.get_loc(pd.Timestamp("2024-03-07", tz="UTC"))
+    oldest = index.get_loc(pd.Timestamp("2024-03-07", tz="UTC") - timedelta(days=730))
+    diffs[day - 6:day - 1] = [12, -4, 14, 9, 12]
+    diffs[oldest + 1:oldest + 6] = diffs[day - 6:day - 1]
+    diffs[oldest] = 10
+    diffs[oldest + 1] += 0.5
+    values = np.round(2000 + np.concatenate(([0], np.cumsum(diffs))), 2)
+    return pd.DataFrame({"prices": values, "volume": 1000.0}, index=index)[::-1]
+
+# Portfolio values of the original day by day run_backtesting on synthetic_prices. A midnight start trades each day
+# at 00:00 and its window includes the bar 730 days earlier. A 15:30 start does not, so it never buys, and it skips
+# 2024-03-28 since the backtest ends at 10:00
+MIDNIGHT_VALUES = [
+    10000.0, 10000.0, 10000.0, 10000.0, 10000.0, 9997.88, 9993.42, 9992.68, 9985.52, 9977.24, 9969.54, 9978.04,
+    9990.28, 9977.62, 9980.5, 9989.96, 9976.98, 9970.94, 9958.48, 9942.98,
+]
+AFTERNOON_VALUES = [10000.0] * 19
+
+@pytest.mark.parametrize("start, end, expected", [
+    (datetime(2024, 3, 1), datetime(2024, 3, 28, 23), MIDNIGHT_VALUES),
+    (datetime(2024, 3, 1, 15, 30), datetime(2024, 3, 28, 10), AFTERNOON_VALUES),
+])
+def test_replay_matches_original_backtest(monkeypatch, tmp_path, start, end, expected):
+    monkeypatch.chdir(tmp_path)
+    backtester = Backtester("SYN", start, end, 10000, display=False, periods=[5, 10], commodity=True, prices=synthetic_prices())
+    values = backtester.replay(backtester.signal_matrix())["Total Value"].to_numpy(dtype=float)
+    assert len(values) == len(expected)
+    assert np.allclose(values, expected)
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+from sattern.src import process
+from sattern.src.pattern_index import pattern_index
+
+def synthetic_prices(n: int, seed: int = 0) -> pd.DataFrame:
+    # Prices that double or halve every day, so every return (1 or -0.5) is exact in the float32 windows of the index
+    rng = np.random.default_rng(seed)
+    values = 100 * np.cumprod(rng.choice([2.0, 0.5], n))
+    index = pd.bdate_range(end="2024-12-31", periods=n, tz="UTC", name="date")
+    return pd.DataFrame({"prices": values}, index=index)[::-1]
+
+def test_distance_forecast_exact_match():
+    following = np.array([[1.0, 2.0], [3.0, 4.0]])
+    forecast = process.distance_forecast(np.array([0.0, 0.0]), following, 0.05)
+    assert np.allclose(forecast, [2.0, 3.0])
+    # The closer match dominates
+    forecast = process.distance_forecast(np.array([0.0, 1.0]), following, 0.05)
+    assert np.isfinite(forecast).all() and np.allclose(forecast, following[0], atol=0.1)
+
+def test_forecast_with_exact_match():
+    prices = synthetic_prices(300)
+    index = pattern_index(period=10)
+    index.add("SYN", prices)
+    # The latest window of the history without its last 50 days is in the index, so it matches at distance 0
+    query = prices.iloc[50:]
+    matches = index.query(query, k=5)
+    assert matches[0][1] == 0
+    prediction = index.forecast(query, matches)
+    assert len(prediction) == index.horizon + 1
+    assert np.isfinite(prediction).all()
+    assert index.action(query)["action"] in ("Strong Buy", "Buy", "Hold", "Sell", "Strong Sell")
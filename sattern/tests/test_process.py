@@ -0,0 +1,30 @@
+import numpy as np
+from sattern.src import process
+
+def random_walk(n: int, seed: int) -> np.ndarray:
+    # Prices newest first, like process.sattern gets them
+    rng = np.random.default_rng(seed)
+    return (100 + np.cumsum(rng.normal(0, 2, n)))[::-1]
+
+def test_fft_forecast_weights_are_non_negative():
+    for seed in range(100):
+        prices = random_walk(500, seed)
+        diffs = process.price_diffs(prices)
+        period = [5, 10, 20][seed % 3]
+        max_diff = [0.5, 2, 5][seed % 3]
+        similar_periods = process.find_similar_periods_fft(diffs, period, k=10)
+        starts = np.array([start for start, _ in similar_periods])
+
+        weights = process.distance_weights(process.match_distances(diffs, starts, period), max_diff)
+        assert (weights >= 0).all()
+        assert np.isclose(weights.sum(), 1)
+
+        # A weighted average of the moves that followed each match stays within their range
+        following = diffs[starts[:, None] - np.arange(period)]
+        forecast = process.sattern_forecast(diffs, similar_periods, period, max_diff, mode="fft")
+        assert (forecast >= following.min(axis=0) - 1e-9).all() and (forecast <= following.max(axis=0) + 1e-9).all()
+
+def test_match_distances_agree_with_distance_profile():
+    diffs = process.price_diffs(random_walk(300, 0))
+    starts, distances, _ = process.distance_profile(diffs, 10)
+    assert np.allclose(process.match_distances(diffs, starts, 10), distances, atol=1e-6)